@@ -19,6 +19,26 @@ import psycopg2
 from optparse import OptionParser, OptionGroup
 import logging
 import inspect
+import math
+from multiprocessing.pool import ThreadPool
+import array
+import mmap
+import struct
+import json
+import re
+import threading
+import BaseHTTPServer
+import SocketServer
+import csv
+import gzip
+import zlib
+import signal
+import subprocess
+from collections import deque
+try:
+	from collections import OrderedDict
+except ImportError:
+	OrderedDict = dict
 
 
 class DB:
@@ -32,11 +52,19 @@ class DB:
 	def get_name(self):
 		return self.database
 
+	def get_host(self):
+		if str(self.port) == "5432":
+			return self.host
+		return "%s:%s" % (self.host, self.port)
+
 	def __str__(self):
 		return "%s@%s:%s db %s" % (self.user, self.host, self.port, self.database)
 
-	def connect(self):
-		return psycopg2.connect(**(self.__dict__))
+	def connect(self, timeout=None):
+		kwargs = dict(self.__dict__)
+		if timeout:
+			kwargs["connect_timeout"] = int(math.ceil(timeout))
+		return psycopg2.connect(**kwargs)
 
 	@staticmethod
 	def _execute_fetch(con, query, fetchfn, *args):
@@ -67,96 +95,469 @@ class DB:
 			return ret[0]
 
 
+# libpq connection string, either 'key=value ...' or an URI
+class DSN(DB):
+	def __init__(self, dsn):
+		self.dsn = dsn
+		self.params = {}
+		if "://" in dsn:
+			import urlparse
+			u = urlparse.urlparse(dsn)
+			self.params["host"] = u.hostname or "localhost"
+			self.params["port"] = u.port or 5432
+			self.params["dbname"] = u.path.lstrip("/")
+			self.params["user"] = u.username or ""
+		else:
+			for kv in dsn.split():
+				if "=" in kv:
+					k, v = kv.split("=", 1)
+					self.params[k] = v.strip("'")
+
+	def get_name(self):
+		return self.params.get("dbname", "")
+
+	def get_host(self):
+		host = self.params.get("host", "localhost")
+		port = str(self.params.get("port", 5432))
+		return host if port == "5432" else "%s:%s" % (host, port)
+
+	def __str__(self):
+		return "%s@%s db %s" % (self.params.get("user", ""), self.get_host(), self.get_name())
+
+	def connect(self, timeout=None):
+		dsn = self.dsn
+		if timeout and "connect_timeout" not in self.params and "connect_timeout=" not in dsn:
+			param = "connect_timeout=%d" % int(math.ceil(timeout))
+			if "://" in dsn:
+				dsn += ("&" if "?" in dsn else "?") + param
+			else:
+				dsn += " " + param
+		return psycopg2.connect(dsn)
+
+
 class PgVersion:
-	def __init__(self, con):
-		self.str = DB.execute_fetchval(con, "SELECT version()")
-		self.maj = DB.execute_fetchval(con, "SELECT substring(version() from $$(\d+)\.\d+\.\d+$$)::smallint;")
-		self.min = DB.execute_fetchval(con, "SELECT substring(version() from $$\d+\.(\d+)\.\d+$$)::smallint;")
+	# either asks the server behind con or takes the given (e.g. recorded) version
+	def __init__(self, con=None, num=0, version_str=""):
+		if con is not None:
+			version_str, num = DB.execute_fetchone(con,
+				"SELECT version(), current_setting('server_version_num')::int")
+		self.str = version_str
+		self.num = num
+		self.maj = num / 10000
+		self.min = (num / 100) % 100
 
 	def ge(self, maj, min):
 		return self.maj > maj or (self.maj >= maj and self.min >= min)
 
 
+def _monotonic_clock():
+	if hasattr(time, "monotonic"):
+		return time.monotonic
+	try:
+		import ctypes
+		import ctypes.util
+
+		class timespec(ctypes.Structure):
+			_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+		CLOCK_MONOTONIC = 1
+		librt = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"), use_errno=True)
+		clock_gettime = librt.clock_gettime
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+		def monotonic():
+			t = timespec()
+			if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)):
+				errno = ctypes.get_errno()
+				raise OSError(errno, os.strerror(errno))
+			return t.tv_sec + t.tv_nsec * 1e-9
+
+		monotonic()
+		return monotonic
+	except Exception:
+		return time.time
+
+monotonic = _monotonic_clock()
+
+
+# Fires on absolute deadlines of the monotonic clock, so the time spent on
+# polling is not added to the interval and the rows do not drift.
+class Ticker:
+	def __init__(self, delay):
+		self.delay = delay
+		self.deadline = monotonic()
+		self.skipped = 0
+
+	def wait(self):
+		self.deadline += self.delay
+		now = monotonic()
+		if now > self.deadline:
+			# the poll took longer than the interval, skip to the next deadline
+			n = int((now - self.deadline) / self.delay) + 1
+			self.deadline += n * self.delay
+			self.skipped += n
+			logging.debug("poll overran the interval, %d tick(s) skipped" % n)
+		time.sleep(self.deadline - now)
+
+
+MIN_DELAY = 0.1
+
 opts = None
-con = None
 
 class PgStatStore:
+	scalar = True # one number per column, see PgStatRecorder
 	def __init__(self, table=None, cols=None):
+		self.name = table
 		self.table = table
 		self.cols = cols
+		self.store = {}
 
-	def update(self):
-		query = ["SUM(%s)" % c for c in self.cols]
+	def keys(self):
+		return ["%s.%s" % (self.name, c) for c in self.cols]
 
-		ret = DB.execute_fetchone(con, "SELECT %s FROM %s" % (", ".join(query), self.table))
+	def sql(self):
+		query = ["COALESCE(SUM(%s), 0) AS %s" % (c, c) for c in self.cols]
+		return "SELECT %s FROM %s" % (", ".join(query), self.table)
+
+	# called in the transaction of the snapshot, before its statement
+	def prepare(self, con):
+		pass
+
+	def load(self, ret):
 		self.store = {}
 		n = 0
 		for c in self.cols:
 			self.store[c] = ret[n]
 			n += 1
 
+# Scan counters of the tables with more than opts.scan_threshold rows. The
+# catalog is searched for such tables every opts.scan_refresh seconds, or
+# sooner when tables are created, dropped or cross the threshold, and every
+# tick fetches the counters of the tables found by oid. The sums are kept
+# continuous when the set of tables changes.
+RELCACHE_CHECK = 60 # how often to look for changed tables, sec
+# VACUUM and ANALYZE set reltuples in place, which no pg_class counter
+# shows, so the check reads pg_class too: a digest of the tables over the
+# threshold changes when one crosses it either way. It is one scan of
+# pg_class, without the join of the refresh.
+PG_CLASS_CHANGES_SQL = "SELECT pg_stat_get_tuples_inserted('pg_class'::regclass) + " \
+	"pg_stat_get_tuples_updated('pg_class'::regclass) + " \
+	"pg_stat_get_tuples_deleted('pg_class'::regclass), " \
+	"(SELECT md5(string_agg(oid::text, ',' ORDER BY oid)) FROM pg_class " \
+	"WHERE relkind = 'r' AND reltuples > %d)"
+
 class PgStatStoreBigUserTables(PgStatStore):
 	def __init__(self, cols):
-		self.cols = cols
-
-	def update(self):
-		query = ["SUM(p.%s)" % c for c in self.cols]
+		PgStatStore.__init__(self, "pg_stat_user_tables", cols)
+		self.name = "big_user_tables"
+		self.relids = None
+		self.offset = {}
+		self.refreshed = None
+		self.checked = None
+		self.pg_class_changes = None
 
-		ret = DB.execute_fetchone(con,
-			"SELECT %s FROM pg_stat_user_tables p, pg_class c "
-			"WHERE p.relname = c.relname AND c.reltuples > %d" %
-			(", ".join(query), int(opts.scan_threshold)))
-		self.store = {}
-		n = 0
+	@staticmethod
+	def oids(relids):
+		return "'{%s}'::oid[]" % ",".join([str(int(r)) for r in relids])
+
+	def prepare(self, con):
+		now = monotonic()
+		changes = None
+		if self.relids is not None and now - self.refreshed < opts.scan_refresh:
+			if now - self.checked < RELCACHE_CHECK:
+				return
+			self.checked = now
+			changes = DB.execute_fetchone(con, PG_CLASS_CHANGES_SQL % int(opts.scan_threshold))
+			if changes == self.pg_class_changes:
+				return
+		self.refresh(con, changes)
+
+	def refresh(self, con, changes=None):
+		if changes is None:
+			changes = DB.execute_fetchone(con, PG_CLASS_CHANGES_SQL % int(opts.scan_threshold))
+		self.pg_class_changes = changes
+		relids = sorted([r[0] for r in DB.execute_fetchall(con, "SELECT p.relid FROM pg_stat_user_tables p " \
+			"JOIN pg_class c ON c.oid = p.relid WHERE c.reltuples > %d" % int(opts.scan_threshold))])
+		if self.relids is not None and relids != self.relids:
+			# both sums at the same moment, so the change of the set is no scan
+			sums = ["COALESCE(SUM(CASE WHEN relid = ANY(%s) THEN %s END), 0)" % (self.oids(r), c) \
+				for c in self.cols for r in (self.relids, relids)]
+			ret = DB.execute_fetchone(con, "SELECT %s FROM pg_stat_user_tables WHERE relid = ANY(%s)" % \
+				(", ".join(sums), self.oids(self.relids + relids)))
+			for n, c in enumerate(self.cols):
+				self.offset[c] = self.offset.get(c, 0) + ret[2 * n + 1] - ret[2 * n]
+		logging.debug("%d tables with more than %d rows" % (len(relids), opts.scan_threshold))
+		self.relids = relids
+		self.refreshed = self.checked = monotonic()
+
+	def sql(self):
+		query = ["COALESCE(SUM(%s), 0) AS %s" % (c, c) for c in self.cols]
+		return "SELECT %s FROM pg_stat_user_tables WHERE relid = ANY(%s)" % \
+			(", ".join(query), self.oids(self.relids or []))
+
+	def load(self, ret):
+		PgStatStore.load(self, ret)
 		for c in self.cols:
-			self.store[c] = ret[n]
-			n += 1
+			self.store[c] -= self.offset.get(c, 0)
 
 class PgStatStoreProc(PgStatStore):
+	def __init__(self, pg_ver):
+		PgStatStore.__init__(self, "pg_stat_activity", ["idle_in_txn", "live"])
+		if pg_ver.ge(9, 2):
+			self.query_col = "query"
+			self.idle_in_txn = "state = 'idle in transaction'"
+			self.live = "state NOT LIKE 'idle%'"
+		else:
+			self.query_col = "current_query"
+			self.idle_in_txn = "current_query = '<IDLE> in transaction'"
+			self.live = "current_query NOT LIKE '<IDLE>%'"
+
+	def sql(self):
+		# the snapshot statement itself mentions pg_stat_activity, so it is not counted
+		return "SELECT COUNT(CASE WHEN %s THEN 1 END) AS idle_in_txn, " \
+			"COUNT(CASE WHEN %s THEN 1 END) AS live FROM pg_stat_activity " \
+			"WHERE datname = current_database() AND %s NOT LIKE '%%pg_stat_activity%%'" % \
+			(self.idle_in_txn, self.live, self.query_col)
+
+# scalar expressions requested by the counters themselves (see DbStatCounter.sql)
+class PgStatStoreExpr(PgStatStore):
+	def __init__(self):
+		PgStatStore.__init__(self, None, [])
+		self.name = "expr"
+		self.exprs = []
+
+	def add(self, col, expr):
+		if col in self.cols:
+			return
+		self.cols.append(col)
+		self.exprs.append(expr)
+
+	def sql(self):
+		return "SELECT %s" % ", ".join(["(%s) AS %s" % (e, c) for c, e in zip(self.cols, self.exprs)])
+
+# one array per column, ordered by datid: the whole pg_stat_database in one row
+class PgStatStorePerDb(PgStatStore):
+	scalar = False
+	def __init__(self, cols, pg_ver):
+		PgStatStore.__init__(self, "pg_stat_database", ["datid", "datname", "stats_reset"] + cols)
+		self.reset_sql = "extract(epoch FROM stats_reset)" if pg_ver.ge(9, 1) else "NULL"
+
+	def sql(self):
+		query = ["array_agg(datid::int8) AS datid", "array_agg(datname::text) AS datname",
+			"array_agg(COALESCE(%s, 0)::float8) AS stats_reset" % self.reset_sql]
+		query += ["array_agg(COALESCE(%s, 0)::float8) AS %s" % (c, c) for c in self.cols[3:]]
+		# datname is NULL for the shared objects entry on 12+
+		return "SELECT %s FROM (SELECT * FROM pg_stat_database WHERE datname IS NOT NULL ORDER BY datid) d" % \
+			", ".join(query)
+
+	def load(self, ret):
+		PgStatStore.load(self, [r or [] for r in ret])
+
+# Combines the queries of all registered stores into a single statement, so
+# every tick costs one round trip and one transaction, and all counters see
+# the same consistent view of the statistics.
+class PgStatSnapshot:
+	def __init__(self, con, pg_ver):
+		self.con = con
+		self.stores = []
+		self.time = None
+		self.dt = 0 # time between the last two snapshots
+		self.cost = 0 # wall time of the last snapshot query
+
+		# rates are computed against the time the server took the statistics
+		# snapshot, so neither query latency nor client clock affect them
+		if pg_ver.ge(9, 3):
+			self.time_sql = "COALESCE(pg_stat_get_snapshot_timestamp(), now())"
+		else:
+			self.time_sql = "now()"
+
+	def add(self, store):
+		if store not in self.stores:
+			self.stores.append(store)
+
+	def query(self):
+		names = ["s%d" % n for n in xrange(0, len(self.stores))]
+		ctes = ["%s AS (%s)" % (names[n], self.stores[n].sql()) for n in xrange(0, len(self.stores))]
+		return "WITH %s\nSELECT extract(epoch FROM %s)::float8, * FROM %s" % \
+			(",\n".join(ctes), self.time_sql, ", ".join(names))
+
 	def update(self):
-		ret = DB.execute_fetchall(con,
-			"SELECT current_query, COUNT(*) FROM pg_stat_activity " + \
-			"WHERE datname = '%s' GROUP BY current_query" % opts.db_name)
+		t0 = monotonic()
+		try:
+			for s in self.stores:
+				s.prepare(self.con)
+			ret = DB.execute_fetchone(self.con, self.query())
+		except:
+			self.con.rollback()
+			raise
+		# statistics are cached until the end of the transaction
+		self.con.commit()
+		self.cost = monotonic() - t0
+		self.load(ret[0], ret[1:])
+
+	def load(self, ts, ret):
+		self.dt = ts - self.time if self.time else 0
+		self.time = ts
+		n = 0
+		for s in self.stores:
+			s.load(ret[n:n + len(s.cols)])
+			n += len(s.cols)
 
-		self.store = {}
-		for row in ret:
-			if "pg_stat_activity" in row[0]:
-				continue
-			self.store[row[0]] = row[1]
+	def keys(self):
+		keys = []
+		for s in self.stores:
+			if s.scalar:
+				keys += s.keys()
+		return keys
+
+	def values(self):
+		vals = []
+		for s in self.stores:
+			if s.scalar:
+				vals += [s.store[c] for c in s.cols]
+		return vals
+
+
+# Recording file: REC_MAGIC, header length, JSON header padded to 8 bytes,
+# then fixed-size records of native doubles: the snapshot time followed by
+# the values of all store columns listed in the header. Appending keeps the
+# file valid, and fixed-size records allow to mmap it and seek by bisection.
+REC_MAGIC = "PGSTREC1"
+REC_HDR = "<8sI"
+
+def rec_read_header(f):
+	magic, hlen = struct.unpack(REC_HDR, f.read(struct.calcsize(REC_HDR)))
+	if magic != REC_MAGIC:
+		raise ValueError("%s is not a pg-stat recording" % f.name)
+	meta = json.loads(f.read(hlen))
+	return meta, struct.calcsize(REC_HDR) + hlen
+
+class PgStatRecorder:
+	def __init__(self, fname, ps, pg_ver):
+		self.keys = ps.snapshot.keys()
+		self.recsize = 8 * (len(self.keys) + 1)
+
+		if os.path.exists(fname) and os.path.getsize(fname):
+			f = open(fname, "rb")
+			try:
+				meta, offset = rec_read_header(f)
+			finally:
+				f.close()
+			if meta["cols"] != self.keys or meta["byteorder"] != sys.byteorder:
+				raise ValueError("%s was recorded with different counters" % fname)
+			# drop the tail of a record interrupted by a crash
+			size = os.path.getsize(fname)
+			tail = (size - offset) % self.recsize
+			self.f = open(fname, "r+b")
+			self.f.truncate(size - tail)
+			self.f.seek(0, os.SEEK_END)
+		else:
+			meta = json.dumps({
+				"version": pg_ver.str,
+				"version_num": pg_ver.num,
+				"scan_threshold": opts.scan_threshold,
+				# active sessions are sampled aside and not recorded
+				"groups": [g[2] for g in ps.groups if g[2] != "ash"],
+				"byteorder": sys.byteorder,
+				"cols": self.keys,
+			})
+			hlen = len(meta)
+			hlen += -(struct.calcsize(REC_HDR) + hlen) % 8
+			self.f = open(fname, "wb")
+			self.f.write(struct.pack(REC_HDR, REC_MAGIC, hlen) + meta.ljust(hlen))
+			self.f.flush()
+
+	def write(self, snapshot):
+		array.array("d", [snapshot.time] + [float(v) for v in snapshot.values()]).tofile(self.f)
+		self.f.flush()
+
+	def close(self):
+		self.f.close()
+
+class PgStatRecording:
+	def __init__(self, fname):
+		self.f = open(fname, "rb")
+		self.meta, self.offset = rec_read_header(self.f)
+		self.keys = self.meta["cols"]
+		self.recsize = 8 * (len(self.keys) + 1)
+		self.swap = self.meta["byteorder"] != sys.byteorder
+		self.time_fmt = "<d" if self.meta["byteorder"] == "little" else ">d"
+		self.count = (os.fstat(self.f.fileno()).st_size - self.offset) / self.recsize
+		self.mm = None
+		if self.count:
+			self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, n):
+		off = self.offset + n * self.recsize
+		rec = array.array("d")
+		rec.fromstring(self.mm[off:off + self.recsize])
+		if self.swap:
+			rec.byteswap()
+		return rec
+
+	def time(self, n):
+		off = self.offset + n * self.recsize
+		return struct.unpack_from(self.time_fmt, self.mm, off)[0]
+
+	# index of the first record taken at ts or later
+	def find(self, ts):
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) / 2
+			if self.time(mid) < ts:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def close(self):
+		if self.mm:
+			self.mm.close()
+		self.f.close()
 
 class DbStatCounter:
 	width = 5
 	rate_fmt = None
 	absolute = False
-	def __init__(self, store=None):
-		metric_len = len(self.metric)
-		if not self.absolute:
-			metric_len += 2 # '/s'
-		self.width = max(self.width, len(self.title), metric_len)
+	gauge = False # a level, e.g. a size, shown by its rate but no count of events
+	delta = False # show the change per interval rather than per second
+	alarm = False # non-zero value needs a closer look, see PgStatAdaptiveDelay
+	aggregate = "sum" # how to combine the values of several clusters: sum or avg
+	sql = None # {col: expression} to fetch into a PgStatStoreExpr
+	def __init__(self, store=None, sql=None):
+		self.width = max(self.width, len(self.title), len(self.unit()))
 		self.store = store
+		if sql:
+			self.sql = sql
+		if self.sql:
+			for col, expr in self.sql.items():
+				self.store.add(col, expr)
 
 		self.val_initial = 0
 		self.val = 0
 		self.rate = 0
 		self.time = None
+		self.dt = 0
 
-	def update(self):
+	def update(self, ts):
 		prev_val = float(self.val)
-		self.update_action()
 		prev_time = self.time
-		self.time = time.time()
+		self.time = ts
+		self.dt = self.time - prev_time if prev_time else 0
+		self.update_action()
 		logging.debug("%s raw val: %d" % (self.title, self.val))
-		self.rate = 0
 		if self.absolute:
 			self.rate = self.val
-		else:
-			if prev_time:
-				dt = self.time - prev_time
-				if dt:
-					self.rate = (float(self.val) - prev_val) / dt
+		elif self.delta:
+			self.rate = float(self.val) - prev_val if prev_time else 0
+		elif self.dt:
+			self.rate = (float(self.val) - prev_val) / self.dt
+		# else the server has not refreshed its statistics yet, keep the last rate
 		if not self.val_initial:
 			self.val_initial = self.val
-		con.commit()
 
 	def update_action(self):
 		# virtual
@@ -167,14 +568,30 @@ class DbStatCounter:
 			return self.val
 		return self.val - self.val_initial
 
+	def get(self):
+		return self.val if self.absolute else self.rate
+
+	def unit(self):
+		return self.metric if self.absolute or self.delta else "%s/s" % self.metric
+
+	# identifier safe to be used as a metric or column name
+	def name(self):
+		name = ("%s_%s" % (self.title, self.metric)).lower().replace("%", "_pct")
+		return re.sub("_+", "_", re.sub("[^a-z0-9_]", "_", name)).strip("_")
+
+	def format(self, r):
+		fmt = self.rate_fmt if self.rate_fmt else ("%.1f" if r < 100 else "%.0f")
+		return fmt % r
+
 class pgsDbSize(DbStatCounter):
 	title = "DBSize"
 	metric = "KB"
 	width = 8
+	gauge = True
 	help = "size of database in kilobytes"
-	def update_action(self, **kwargs):
-		self.val = DB.execute_fetchval(con, "select pg_database_size('%s')" % opts.db_name)
-		self.val /= 1024
+	sql = {"db_size": "pg_database_size(current_database())"}
+	def update_action(self):
+		self.val = int(self.store.store["db_size"]) / 1024
 
 class pgsWrIns(DbStatCounter):
 	title = "INS"
@@ -219,11 +636,12 @@ class pgsScanIdxPerc(DbStatCounter):
 	metric = "scan%"
 	help = "percentage of sequential scans [100 * pg_stat_database.seq_scan / (.idx_scan + .seq_scan)]"
 	absolute = True
+	aggregate = "avg"
 	def update_action(self):
 		idx = int(self.store.store['idx_scan'])
 		seq = int(self.store.store['seq_scan'])
 
-		if hasattr(self, 'prev_idx'):
+		if self.dt:
 			d_idx = idx - self.prev_idx
 			if d_idx < 0:
 				d_idx = 0
@@ -232,8 +650,6 @@ class pgsScanIdxPerc(DbStatCounter):
 				d_seq = 0
 			tot = d_idx + d_seq
 			self.val = ((100 * int(d_seq)) / float(tot)) if tot else 0
-		else:
-			self.val = 0
 		self.prev_idx = idx
 		self.prev_seq = seq
 
@@ -261,23 +677,28 @@ class pgsCacheHit(DbStatCounter):
 	def update_action(self):
 		self.val = self.store.store['blks_hit']
 
-class pgsIoReadWa(DbStatCounter):
+class DbStatWaitCounter(DbStatCounter):
+	absolute = True
+	aggregate = "avg"
+	col = None
+	def update_action(self):
+		# blk_*_time is a cumulative number of milliseconds
+		wa = float(self.store.store[self.col])
+		if self.dt:
+			self.val = 100 * (wa - self.prev_wa) / (1000 * self.dt)
+		self.prev_wa = wa
+
+class pgsIoReadWa(DbStatWaitCounter):
 	title = "READWA"
 	metric = "wait%"
 	help = "percent of time spent on IO read's wait [100 * pg_stat_database.blk_read_time / wall_time] (>= 9.2)"
-	def update_action(self):
-		td = time.time() - self.time
-		wa = self.store.store['blk_read_time']
-		self.val = 100 * wa / dt if dt else 0
+	col = "blk_read_time"
 
-class pgsIoWriteWa(DbStatCounter):
+class pgsIoWriteWa(DbStatWaitCounter):
 	title = "WRITEWA"
 	metric = "wait%"
 	help = "percent of time spent on IO write's wait [100 * pg_stat_database.blk_write_time / wall_time] (>= 9.2)"
-	def update_action(self):
-		td = time.time() - self.time
-		wa = self.store.store['blk_write_time']
-		self.val = 100 * wa / dt if dt else 0
+	col = "blk_write_time"
 
 class pgsTxnCommit(DbStatCounter):
 	title = "COMMIT"
@@ -300,8 +721,10 @@ class pgsLockWait(DbStatCounter):
 	help = "number of processes waiting for lock [COUNT(*) FROM pg_locks WHERE NOT granted]"
 	rate_fmt = "%d"
 	absolute = True
+	alarm = True
+	sql = {"locks": "SELECT COUNT(*) FROM pg_locks WHERE NOT granted"}
 	def update_action(self):
-		self.val = DB.execute_fetchval(con, "SELECT COUNT(*) FROM pg_locks WHERE NOT granted")
+		self.val = self.store.store["locks"]
 
 class pgsDeadlocks(DbStatCounter):
 	title = "DEADLOCK"
@@ -316,10 +739,10 @@ class pgsProcsIdletxn(DbStatCounter):
 	metric = "idltxn"
 	help = "total number of 'idle in transaction' processes"
 	absolute = True
+	alarm = True
 	rate_fmt = "%d"
 	def update_action(self):
-		key = "<IDLE> in transaction"
-		self.val = int(self.store.store[key]) if self.store.store.has_key(key) else 0
+		self.val = int(self.store.store["idle_in_txn"])
 
 class pgsProcsLive(DbStatCounter):
 	width = 3
@@ -329,54 +752,385 @@ class pgsProcsLive(DbStatCounter):
 	absolute = True
 	rate_fmt = "%d"
 	def update_action(self):
-		self.val = 0
-		for key, val in self.store.store.items():
-			if key.startswith("<IDLE>"):
-				continue
-			self.val += int(val)
+		self.val = int(self.store.store["live"])
+
+class pgsWalBytes(DbStatCounter):
+	title = "WAL"
+	metric = "KB"
+	width = 7
+	help = "WAL written (replayed on a standby) [pg_current_wal_lsn() delta] (>= 9.2)"
+	def update_action(self):
+		self.val = float(self.store.store["wal_lsn"]) / 1024
+
+class pgsWalFpi(DbStatCounter):
+	title = "FPI"
+	metric = "page"
+	help = "full page images written to WAL [pg_stat_wal.wal_fpi] (>= 14)"
+	sql = {"wal_fpi": "SELECT wal_fpi FROM pg_stat_wal"}
+	def update_action(self):
+		self.val = self.store.store["wal_fpi"]
+
+class pgsCkptTimed(DbStatCounter):
+	title = "TIMED"
+	metric = "ckpt"
+	help = "number of scheduled checkpoints in the interval [pg_stat_bgwriter.checkpoints_timed]"
+	delta = True
+	rate_fmt = "%d"
+	def update_action(self):
+		self.val = self.store.store["ckpt_timed"]
+
+class pgsCkptReq(DbStatCounter):
+	title = "REQ"
+	metric = "ckpt"
+	help = "number of requested checkpoints in the interval [pg_stat_bgwriter.checkpoints_req]"
+	delta = True
+	rate_fmt = "%d"
+	def update_action(self):
+		self.val = self.store.store["ckpt_req"]
+
+class pgsBufCkpt(DbStatCounter):
+	title = "CKPT"
+	metric = "buf"
+	help = "buffers written by the checkpointer [pg_stat_bgwriter.buffers_checkpoint]"
+	def update_action(self):
+		self.val = self.store.store["buf_ckpt"]
+
+class pgsBufClean(DbStatCounter):
+	title = "BGWR"
+	metric = "buf"
+	help = "buffers written by the background writer [pg_stat_bgwriter.buffers_clean]"
+	def update_action(self):
+		self.val = self.store.store["buf_clean"]
+
+class pgsBufBackend(DbStatCounter):
+	title = "BACKEND"
+	metric = "buf"
+	help = "buffers written directly by the backends [pg_stat_bgwriter.buffers_backend]"
+	def update_action(self):
+		self.val = self.store.store["buf_backend"]
+
+class pgsTempFiles(DbStatCounter):
+	title = "FILES"
+	metric = "file"
+	help = "number of temporary files created [pg_stat_database.temp_files] (>= 9.2)"
+	def update_action(self):
+		self.val = self.store.store["temp_files"]
+
+class pgsTempBytes(DbStatCounter):
+	title = "SIZE"
+	metric = "KB"
+	width = 6
+	help = "kilobytes written to temporary files [pg_stat_database.temp_bytes] (>= 9.2)"
+	def update_action(self):
+		self.val = float(self.store.store["temp_bytes"]) / 1024
+
+class pgsReplLagBytes(DbStatCounter):
+	title = "LAG"
+	metric = "KB"
+	width = 7
+	help = "replication lag of the slowest standby (of this standby) [pg_stat_replication.replay_lsn] (>= 9.2)"
+	absolute = True
+	rate_fmt = "%d"
+	def update_action(self):
+		self.val = float(self.store.store["lag_bytes"]) / 1024
+
+class pgsReplLagTime(DbStatCounter):
+	title = "LAG"
+	metric = "sec"
+	help = "replication lag in seconds [pg_stat_replication.replay_lag] (>= 9.2, >= 10 on primary)"
+	absolute = True
+	aggregate = "avg"
+	def update_action(self):
+		self.val = self.store.store["lag_time"]
+
+# Average number of active sessions of a wait class over the interval, as
+# seen by PgStatAsh
+class DbStatAshCounter(DbStatCounter):
+	width = 5
+	metric = "aas"
+	absolute = True
+	wait_class = None
+	def update_action(self):
+		self.val = self.store.store[self.wait_class]
+
+class pgsAshCpu(DbStatAshCounter):
+	title = "CPU"
+	help = "active sessions not waiting, i.e. on CPU or in a wait not instrumented (with --ash)"
+	wait_class = "CPU"
+
+class pgsAshIo(DbStatAshCounter):
+	title = "IO"
+	help = "active sessions waiting for I/O (with --ash, >= 9.6)"
+	wait_class = "IO"
+
+class pgsAshLock(DbStatAshCounter):
+	title = "LOCK"
+	help = "active sessions waiting for a heavyweight lock (with --ash)"
+	wait_class = "Lock"
+
+class pgsAshLWLock(DbStatAshCounter):
+	title = "LWLCK"
+	help = "active sessions waiting for a lightweight lock (with --ash, >= 9.6)"
+	wait_class = "LWLock"
+
+class pgsAshIpc(DbStatAshCounter):
+	title = "IPC"
+	help = "active sessions waiting for another process (with --ash, >= 9.6)"
+	wait_class = "IPC"
+
+class pgsAshClient(DbStatAshCounter):
+	title = "CLNT"
+	help = "active sessions waiting for the client (with --ash, >= 9.6)"
+	wait_class = "Client"
+
+class pgsAshOther(DbStatAshCounter):
+	title = "OTHER"
+	help = "active sessions in other waits: timeouts, buffer pins, extensions... (with --ash, >= 9.6)"
+	wait_class = "Other"
+
+def wal_sql(pg_ver, sql):
+	# xlog/location functions and columns were renamed to wal/lsn in 10
+	if pg_ver.ge(10, 0):
+		return sql
+	return sql.replace("pg_wal_lsn_diff", "pg_xlog_location_diff").replace("_wal_", "_xlog_").replace("_lsn", "_location")
+
+# Registry of the counter groups. A group builds its counters for a PgStats
+# instance, taking the stores it needs from it, so all enabled groups are
+# fetched by the same snapshot statement. Groups are selected with --groups
+# and skipped if the (common) server version is older than 'since'.
+counter_groups = []
+
+def register_group(cls):
+	counter_groups.append(cls)
+	return cls
+
+class DbStatGroup:
+	name = None
+	title = None
+	help = ""
+	since = (8, 0)
+	default = True
+
+	def get_title(self):
+		return self.title
+
+	def counters(self, ps):
+		# virtual
+		return []
+
+@register_group
+class dbgDatabase(DbStatGroup):
+	name = "database"
+	title = "DataBase"
+	help = "database size"
+	def counters(self, ps):
+		return [pgsDbSize(ps.expr)]
+
+@register_group
+class dbgWriteOps(DbStatGroup):
+	name = "write_ops"
+	title = "Write Ops"
+	help = "rows written into user tables"
+	def counters(self, ps):
+		s_ut = ps.table("pg_stat_user_tables", ["n_tup_ins", "n_tup_upd", "n_tup_del"])
+		return [pgsWrIns(s_ut), pgsWrUpd(s_ut), pgsWrDel(s_ut)]
+
+@register_group
+class dbgScan(DbStatGroup):
+	name = "scan"
+	help = "scans of the big tables"
+	def get_title(self):
+		return "Scan (tables with >%dK rows)" % (opts.scan_threshold / 1000)
+
+	def counters(self, ps):
+		s_utb = ps.store("big_user_tables", PgStatStoreBigUserTables, ["idx_scan", "seq_scan", "seq_tup_read"])
+		return [pgsScanIdx(s_utb), pgsScanSeq(s_utb), pgsScanIdxPerc(s_utb), pgsScanSeqRows(s_utb)]
+
+@register_group
+class dbgCacheRead(DbStatGroup):
+	name = "cacheread"
+	title = "CacheRead"
+	help = "shared buffers hits and misses"
+	def counters(self, ps):
+		s_db = ps.table("pg_stat_database", ["blks_hit", "blks_read"])
+		return [pgsCacheHit(s_db), pgsCacheMiss(s_db)]
+
+@register_group
+class dbgLocks(DbStatGroup):
+	name = "locks"
+	title = "Locks"
+	help = "lock waits and deadlocks"
+	def counters(self, ps):
+		ret = [pgsLockWait(ps.expr)]
+		if ps.pg_ver.ge(9, 2):
+			ret.append(pgsDeadlocks(ps.table("pg_stat_database", ["deadlocks"])))
+		return ret
+
+@register_group
+class dbgTransactions(DbStatGroup):
+	name = "transactions"
+	title = "Transactions"
+	help = "commits and rollbacks"
+	def counters(self, ps):
+		s_db = ps.table("pg_stat_database", ["xact_commit", "xact_rollback"])
+		return [pgsTxnCommit(s_db), pgsTxnRollback(s_db)]
+
+@register_group
+class dbgProc(DbStatGroup):
+	name = "proc"
+	title = "Proc"
+	help = "idle in transaction and active backends"
+	def counters(self, ps):
+		s_pr = ps.store("proc", PgStatStoreProc, ps.server_ver)
+		return [pgsProcsIdletxn(s_pr), pgsProcsLive(s_pr)]
+
+@register_group
+class dbgDiskWait(DbStatGroup):
+	name = "disk_wait"
+	title = "Disk Wait"
+	help = "time spent waiting for IO (needs track_io_timing)"
+	since = (9, 2)
+	def counters(self, ps):
+		s_db = ps.table("pg_stat_database", ["blk_read_time", "blk_write_time"])
+		return [pgsIoReadWa(s_db), pgsIoWriteWa(s_db)]
+
+@register_group
+class dbgWal(DbStatGroup):
+	name = "wal"
+	title = "WAL"
+	help = "WAL volume"
+	since = (9, 2)
+	default = False
+	def counters(self, ps):
+		lsn = wal_sql(ps.server_ver, "pg_wal_lsn_diff(CASE WHEN pg_is_in_recovery() " \
+			"THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END, '0/0')")
+		ret = [pgsWalBytes(ps.expr, {"wal_lsn": "COALESCE(%s, 0)" % lsn})]
+		if ps.pg_ver.ge(14, 0):
+			ret.append(pgsWalFpi(ps.expr))
+		return ret
+
+@register_group
+class dbgBgWriter(DbStatGroup):
+	name = "bgwriter"
+	title = "Checkpoints, buffers written"
+	help = "checkpoints and buffers written by checkpointer, bgwriter and backends"
+	default = False
+	def counters(self, ps):
+		if ps.server_ver.ge(17, 0):
+			sql = {
+				"ckpt_timed": "SELECT num_timed FROM pg_stat_checkpointer",
+				"ckpt_req": "SELECT num_requested FROM pg_stat_checkpointer",
+				"buf_ckpt": "SELECT buffers_written FROM pg_stat_checkpointer",
+				"buf_backend": "SELECT COALESCE(SUM(writes), 0) FROM pg_stat_io WHERE backend_type = 'client backend'",
+			}
+		else:
+			sql = {
+				"ckpt_timed": "SELECT checkpoints_timed FROM pg_stat_bgwriter",
+				"ckpt_req": "SELECT checkpoints_req FROM pg_stat_bgwriter",
+				"buf_ckpt": "SELECT buffers_checkpoint FROM pg_stat_bgwriter",
+				"buf_backend": "SELECT buffers_backend FROM pg_stat_bgwriter",
+			}
+		sql["buf_clean"] = "SELECT buffers_clean FROM pg_stat_bgwriter"
+		return [
+			pgsCkptTimed(ps.expr, {"ckpt_timed": sql["ckpt_timed"]}),
+			pgsCkptReq(ps.expr, {"ckpt_req": sql["ckpt_req"]}),
+			pgsBufCkpt(ps.expr, {"buf_ckpt": sql["buf_ckpt"]}),
+			pgsBufClean(ps.expr, {"buf_clean": sql["buf_clean"]}),
+			pgsBufBackend(ps.expr, {"buf_backend": sql["buf_backend"]}),
+		]
+
+@register_group
+class dbgTemp(DbStatGroup):
+	name = "temp"
+	title = "Temp Files"
+	help = "temporary files written by sorts and hashes"
+	since = (9, 2)
+	default = False
+	def counters(self, ps):
+		s_db = ps.table("pg_stat_database", ["temp_files", "temp_bytes"])
+		return [pgsTempFiles(s_db), pgsTempBytes(s_db)]
+
+@register_group
+class dbgReplication(DbStatGroup):
+	name = "replication"
+	title = "Replication"
+	help = "replication lag, of the slowest standby on a primary"
+	since = (9, 2)
+	default = False
+	def counters(self, ps):
+		lag_bytes = wal_sql(ps.server_ver, "CASE WHEN pg_is_in_recovery() " \
+			"THEN pg_wal_lsn_diff(pg_last_wal_receive_lsn(), pg_last_wal_replay_lsn()) " \
+			"ELSE (SELECT MAX(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)) FROM pg_stat_replication) END")
+		standby_lag = wal_sql(ps.server_ver, "CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 " \
+			"ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END")
+		if ps.server_ver.ge(10, 0):
+			primary_lag = "(SELECT extract(epoch FROM MAX(replay_lag)) FROM pg_stat_replication)"
+		else:
+			primary_lag = "NULL"
+		lag_time = "CASE WHEN pg_is_in_recovery() THEN %s ELSE %s END" % (standby_lag, primary_lag)
+		return [
+			pgsReplLagBytes(ps.expr, {"lag_bytes": "COALESCE(%s, 0)" % lag_bytes}),
+			pgsReplLagTime(ps.expr, {"lag_time": "COALESCE(%s, 0)::float8" % lag_time}),
+		]
+
+def default_groups():
+	return [g.name for g in counter_groups if g.default]
 
 class PgStats:
-	def __init__(self):
+	# server_ver is the version of the server behind con, layout_ver (if any)
+	# is used to choose the counters, so several clusters can share one layout.
+	# ash is a running PgStatAsh to show the active sessions of.
+	def __init__(self, con, server_ver, layout_ver=None, groups=None, ash=None):
 		self.sep = " |"
 		self.hdr_titles = ""
 		self.hdr_metrics = ""
 		self.fmt = ""
 
-		pg_ver = PgVersion(con)
-		print pg_ver.str
-
-		s_db = PgStatStore("pg_stat_database", ["xact_commit", "xact_rollback", "blks_read", "blks_hit"])
-		s_ut = PgStatStore("pg_stat_user_tables", ["n_tup_ins", "n_tup_upd", "n_tup_del"])
-		s_utb = PgStatStoreBigUserTables(["idx_scan", "seq_scan", "seq_tup_read"])
-		s_pr = PgStatStoreProc()
+		self.pg_ver = layout_ver or server_ver
+		self.server_ver = server_ver
+		self.stores = {}
+		self.snapshot = PgStatSnapshot(con, server_ver)
+		self.expr = self.store("expr", PgStatStoreExpr)
+
+		if groups is None:
+			groups = opts.groups
+		self.groups = []
+		for cls in counter_groups:
+			if cls.name not in groups:
+				continue
+			if not self.pg_ver.ge(*cls.since):
+				logging.warning("'%s' counters need PostgreSQL %d.%d or newer" % ((cls.name,) + cls.since))
+				continue
+			g = cls()
+			self.groups.append((g.get_title(), g.counters(self), g.name))
+		self.ash = ash
+		if ash:
+			self.groups.append(("Active Sessions", ash.counters(), "ash"))
 
-		if pg_ver.ge(9, 2):
-			s_db.append("deadlocks")
-			s_db.append("blk_read_time")
-			s_db.append("blk_write_time")
-
-		self.stores = [s_db, s_ut, s_utb, s_pr]
-
-		self.groups = [
-			("DataBase",  [pgsDbSize()]),
-			("Write Ops", [pgsWrIns(s_ut), pgsWrUpd(s_ut), pgsWrDel(s_ut)]),
-			("Scan (tables with >%dK rows)" % (opts.scan_threshold / 1000),
-				[pgsScanIdx(s_utb), pgsScanSeq(s_utb), pgsScanIdxPerc(s_utb), pgsScanSeqRows(s_utb)]),
-			("CacheRead", [pgsCacheHit(s_db), pgsCacheMiss(s_db)]),
-			("Locks", [pgsLockWait()] + ([pgsDeadlocks(s_db)] if pg_ver.ge(9, 2) else [])),
-			("Transactions", [pgsTxnCommit(s_db), pgsTxnRollback(s_db)]),
-			("Proc", [pgsProcsIdletxn(s_pr), pgsProcsLive(s_pr)]),
-		]
+		self.init()
 
-		if pg_ver.ge(9, 2):
-			self.groups.append(("Disk Wait", [pgsIoReadWa(s_db), pgsIoWriteWa(s_db)]))
+	def store(self, key, factory, *args):
+		if key not in self.stores:
+			self.stores[key] = factory(*args)
+			self.snapshot.add(self.stores[key])
+		return self.stores[key]
 
-		self.init()
+	# the store summing given columns of a pg_stat_xxx table
+	def table(self, table, cols):
+		s = self.store(table, PgStatStore, table, [])
+		for c in cols:
+			if c not in s.cols:
+				s.cols.append(c)
+		return s
 
 	def init(self):
 		self.counters = []
 
 		for group in self.groups:
+			# widen the first counter if the group title does not fit
+			room = sum(c.width + 1 for c in group[1]) - 1
+			if len(group[0]) > room:
+				group[1][0].width += len(group[0]) - room
 			for c in group[1]:
 				self.counters.append(c)
 				self.hdr_metrics += " " + c.title.rjust(c.width)
@@ -385,54 +1139,1520 @@ class PgStats:
 			self.hdr_metrics += self.sep
 			self.fmt += self.sep
 
-	def header(self):
-		print "=" * len(self.hdr_titles)
-		print self.hdr_titles
-		print self.hdr_metrics
+	# lead is the header of extra leading columns, e.g. time and host in fleet mode
+	def header(self, lead=""):
+		pad = " " * len(lead)
+		print "=" * (len(lead) + len(self.hdr_titles))
+		print pad + self.hdr_titles
+		print lead + self.hdr_metrics
 		if opts.abs:
 			metrics = [c.metric for c in self.counters]
 		else:
-			metrics = [c.metric if c.absolute else "%s/s" % c.metric for c in self.counters]
-		print self.fmt % tuple(metrics)
-		print "+" * len(self.hdr_titles)
+			metrics = [c.unit() for c in self.counters]
+		print pad + self.fmt % tuple(metrics)
+		print "+" * (len(lead) + len(self.hdr_titles))
 
-	def print_row(self):
+	# marks are the indexes of the counters to highlight
+	def row(self, marks=()):
 		if opts.abs:
 			vals = ["%d" % c.abs() for c in self.counters]
 		else:
-			vals = []
-			for c in self.counters:
-				r = c.val if c.absolute else c.rate
-				fmt = c.rate_fmt if c.rate_fmt else ("%.1f" if r < 100 else "%.0f")
-				vals.append(fmt % r)
-		print self.fmt % tuple(vals)
+			vals = [c.format(c.get()) for c in self.counters]
+		for n in marks:
+			vals[n] = highlight(vals[n], self.counters[n].width)
+		return vals
+
+	def print_row(self, lead="", marks=()):
+		print lead + self.fmt % tuple(self.row(marks))
 
 	def update(self):
-		for s in self.stores:
-			s.update()
+		self.snapshot.update()
+		if self.ash:
+			self.ash.aggregate()
+		self.update_counters()
+
+	def update_counters(self):
 		for c in self.counters:
-			c.update()
+			c.update(self.snapshot.time)
+
+def highlight(s, width):
+	if sys.stdout.isatty():
+		return "\033[7m%s\033[0m" % s.rjust(width)
+	if len(s) >= width:
+		# no cell left for the marker, the line must stay aligned
+		return s.rjust(width)
+	return ("*" + s).rjust(width)
+
+def info(msg):
+	# keep stdout clean for the machine-readable formats
+	print >> (sys.stdout if opts.format == "text" else sys.stderr), msg
+
+def num(v):
+	if isinstance(v, float):
+		return v
+	return int(v) if v == int(v) else float(v)
+
+# Machine-readable output: one record per tick, full-precision values keyed
+# by group and counter names, flushed line by line
+class PgStatRecordOutput:
+	def __init__(self, ps, fleet=False):
+		self.fields = []
+		for group in ps.groups:
+			self.fields += [(group[2], c.name()) for c in group[1]]
+		self.fleet = fleet
+		self.interval = opts.adaptive # the interval varies, so it is a column
+		self.f = sys.stdout
+
+	def values(self, ps):
+		return [num(c.abs() if opts.abs else c.get()) for c in ps.counters]
+
+	def header(self):
+		pass
+
+	def flush(self):
+		self.f.flush()
+
+class PgStatCsvOutput(PgStatRecordOutput):
+	def __init__(self, ps, fleet=False):
+		PgStatRecordOutput.__init__(self, ps, fleet)
+		self.w = csv.writer(self.f, lineterminator="\n")
 
-def pg_usage():
-	ps = PgStats()
-	ps.header()
+	def header(self):
+		self.w.writerow(["ts"] + (["interval"] if self.interval else []) + \
+			(["host", "error"] if self.fleet else []) + ["%s.%s" % f for f in self.fields])
+		self.flush()
+
+	def write(self, ts, vals, host=None, error=None, interval=None):
+		row = [repr(ts)]
+		if self.interval:
+			row.append(repr(interval))
+		if self.fleet:
+			row += [host, error or ""]
+		if vals is None:
+			row += [""] * len(self.fields)
+		else:
+			row += [repr(v) for v in vals]
+		self.w.writerow(row)
+		self.flush()
+
+class PgStatJsonOutput(PgStatRecordOutput):
+	def write(self, ts, vals, host=None, error=None, interval=None):
+		rec = OrderedDict()
+		rec["ts"] = ts
+		if self.interval:
+			rec["interval"] = interval
+		if self.fleet:
+			rec["host"] = host
+			if error:
+				rec["error"] = error
+		if vals is not None:
+			for (g, c), v in zip(self.fields, vals):
+				rec.setdefault(g, OrderedDict())[c] = v
+		self.f.write(json.dumps(rec) + "\n")
+		self.flush()
+
+def make_output(ps, fleet=False):
+	if opts.format == "csv":
+		return PgStatCsvOutput(ps, fleet)
+	if opts.format == "jsonl":
+		return PgStatJsonOutput(ps, fleet)
+	return None
+
+# Streaming estimate of the p-quantile in constant memory, the P-square
+# algorithm of Jain and Chlamtac: five markers track the minimum, p/2, p,
+# (1+p)/2 quantiles and the maximum and are moved with a piecewise-parabolic
+# interpolation as samples come
+class P2Quantile:
+	def __init__(self, p):
+		self.p = p
+		self.q = [] # marker heights
+		self.n = [0, 1, 2, 3, 4] # marker positions
+		self.np = [0, 2 * p, 4 * p, 2 + 2 * p, 4] # desired positions
+		self.dn = [0, p / 2, p, (1 + p) / 2, 1]
+
+	def add(self, x):
+		q, n = self.q, self.n
+		if len(q) < 5:
+			q.append(x)
+			q.sort()
+			return
+
+		if x < q[0]:
+			q[0] = x
+			k = 0
+		elif x >= q[4]:
+			q[4] = x
+			k = 3
+		else:
+			k = 0
+			while x >= q[k + 1]:
+				k += 1
+		for i in xrange(k + 1, 5):
+			n[i] += 1
+		for i in xrange(0, 5):
+			self.np[i] += self.dn[i]
+
+		for i in (1, 2, 3):
+			d = self.np[i] - n[i]
+			if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+				d = 1 if d > 0 else -1
+				h = self.parabolic(i, d)
+				if not q[i - 1] < h < q[i + 1]:
+					h = q[i] + d * (q[i + d] - q[i]) / float(n[i + d] - n[i])
+				q[i] = h
+				n[i] += d
+
+	def parabolic(self, i, d):
+		q, n = self.q, self.n
+		return q[i] + d / float(n[i + 1] - n[i - 1]) * \
+			((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i]) + \
+			(n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / float(n[i] - n[i - 1]))
+
+	def get(self):
+		if not self.q:
+			return 0
+		if len(self.q) < 5:
+			# too few samples for the markers, they are sorted anyway
+			return self.q[int(round(self.p * (len(self.q) - 1)))]
+		return self.q[2]
+
+# Running statistics of one counter: min, max, mean and standard deviation
+# (Welford's method), a few quantiles of the rate and the total change of
+# the raw value
+class DbStatSummary:
+	quantiles = (0.5, 0.95, 0.99)
+	def __init__(self):
+		self.n = 0
+		self.min = None
+		self.max = None
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.q = [P2Quantile(p) for p in self.quantiles]
+		self.first = None
+		self.last = None
+
+	def add(self, c):
+		r = float(c.get())
+		self.n += 1
+		self.min = r if self.min is None else min(self.min, r)
+		self.max = r if self.max is None else max(self.max, r)
+		d = r - self.mean
+		self.mean += d / self.n
+		self.m2 += d * (r - self.mean)
+		for q in self.q:
+			q.add(r)
+		if self.first is None:
+			self.first = c.val
+		self.last = c.val
+
+	def stddev(self):
+		return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+	def total(self, c):
+		# the change over the run makes no sense for gauges
+		if c.absolute or self.first is None:
+			return None
+		return self.last - self.first
+
+class PgStatSummary:
+	def __init__(self, ps):
+		self.fields = []
+		for group in ps.groups:
+			self.fields += [("%s.%s" % (group[2], c.name()), c) for c in group[1]]
+		self.stats = [DbStatSummary() for f in self.fields]
+		self.start = None
+		self.end = None
+
+	# ps is of the same layout as the one given to the constructor, it can be
+	# another instance when a cluster has been reconnected
+	def add(self, ps):
+		if self.start is None:
+			self.start = ps.snapshot.time
+		self.end = ps.snapshot.time
+		for s, c in zip(self.stats, ps.counters):
+			s.add(c)
+
+	def samples(self):
+		return self.stats[0].n if self.stats else 0
+
+	def to_dict(self):
+		d = OrderedDict()
+		d["start"] = self.start
+		d["end"] = self.end
+		d["samples"] = self.samples()
+		d["counters"] = OrderedDict()
+		for (key, c), s in zip(self.fields, self.stats):
+			v = OrderedDict()
+			v["unit"] = c.unit()
+			v["min"] = num(s.min or 0)
+			v["max"] = num(s.max or 0)
+			v["mean"] = s.mean
+			v["stddev"] = s.stddev()
+			for p, q in zip(s.quantiles, s.q):
+				v["p%d" % int(p * 100)] = num(q.get())
+			v["total"] = s.total(c)
+			if v["total"] is not None:
+				v["total"] = num(v["total"])
+			d["counters"][key] = v
+		return d
+
+	def write(self, f, title=None):
+		if not self.samples():
+			print >> f, "%sno samples to summarize" % (title + ": " if title else "")
+			return
+		name_w = max(len(key) for key, c in self.fields)
+		unit_w = max(len(c.unit()) for key, c in self.fields)
+		cols = ["MIN", "MAX", "MEAN", "STDDEV"] + ["P%d" % int(p * 100) for p in DbStatSummary.quantiles] + ["TOTAL"]
+		print >> f, "=" * (name_w + unit_w + 11 * len(cols) + 1)
+		print >> f, "%s%d samples, %s - %s (%.0f sec)" % (title + ": " if title else "", self.samples(),
+			time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start)),
+			time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.end)), self.end - self.start)
+		print >> f, "%s %s" % ("COUNTER".ljust(name_w), "UNIT".ljust(unit_w)) + "".join(" %10s" % h for h in cols)
+		for (key, c), s in zip(self.fields, self.stats):
+			vals = [s.min, s.max, s.mean, s.stddev()] + [q.get() for q in s.q]
+			row = "".join(" %10s" % c.format(v) for v in vals)
+			total = s.total(c)
+			row += " %10s" % ("-" if total is None else "%d" % total)
+			print >> f, "%s %s" % (key.ljust(name_w), c.unit().ljust(unit_w)) + row
+
+# Prints the summaries of the run, {title: summary} in fleet mode
+def print_summary(summary):
+	if isinstance(summary, PgStatSummary):
+		summary = {None: summary}
+	if opts.summary:
+		f = sys.stdout if opts.format == "text" else sys.stderr
+		for title, s in summary.items():
+			s.write(f, title)
+	if opts.summary_json:
+		if None in summary:
+			d = summary[None].to_dict()
+		else:
+			d = OrderedDict((title, s.to_dict()) for title, s in summary.items())
+		if opts.summary_json == "-":
+			print json.dumps(d, indent=2)
+		else:
+			f = open(opts.summary_json, "w")
+			try:
+				json.dump(d, f, indent=2)
+				f.write("\n")
+			finally:
+				f.close()
+
+# Active session history: a thread with its own connection samples
+# pg_stat_activity opts.ash_rate times a second. Every sample is reduced to
+# the number of active sessions per wait class and put into a ring buffer,
+# which is averaged once per tick. Totals per wait event and per query are
+# kept for the breakdown printed at exit.
+ASH_WINDOW = 60 # seconds of samples kept in the ring buffer
+ASH_MAX_QUERIES = 1000
+ASH_RECONNECT_MAX = 30 # seconds between the attempts to connect at most
+
+class PgStatAsh(threading.Thread):
+	classes = ["CPU", "IO", "Lock", "LWLock", "IPC", "Client", "Other"]
+	counter_classes = [pgsAshCpu, pgsAshIo, pgsAshLock, pgsAshLWLock, pgsAshIpc, pgsAshClient, pgsAshOther]
+
+	def __init__(self, db, pg_ver, rate, timeout=None):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		if not pg_ver.ge(9, 2):
+			raise ValueError("--ash needs PostgreSQL 9.2 or newer")
+		self.db = db
+		self.con = None
+		self.timeout = timeout
+		self.reconnect = 0 # when to try to connect again
+		self.backoff = 1
+		self.delay = 1.0 / rate
+		self.sql = self.query(pg_ver)
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.ring = deque(maxlen=max(int(rate * ASH_WINDOW), 1))
+		self.seq = 0
+		self.seen = 0
+		self.store = dict((c, 0) for c in self.classes)
+		self.events = {} # (wait class, wait event): sessions seen
+		self.queries = {} # fingerprint: [sessions seen, query text]
+		self.errors = 0
+
+	@staticmethod
+	def query(pg_ver):
+		if pg_ver.ge(9, 6):
+			wait = "COALESCE(wait_event_type, 'CPU'), COALESCE(wait_event, 'CPU')"
+		else:
+			wait = "CASE WHEN waiting THEN 'Lock' ELSE 'CPU' END, CASE WHEN waiting THEN 'waiting' ELSE 'CPU' END"
+		if pg_ver.ge(14, 0):
+			# query_id is NULL unless compute_query_id is on
+			fp = "COALESCE(query_id::text, md5(query))"
+		else:
+			fp = "md5(query)"
+		return "PREPARE pgstat_ash AS SELECT %s, %s, left(query, 80) FROM pg_stat_activity " \
+			"WHERE state = 'active' AND pid <> pg_backend_pid()" % (wait, fp)
+
+	def counters(self):
+		return [cls(self) for cls in self.counter_classes]
+
+	def wait_class(self, wait_type):
+		# 9.6 has LWLockNamed and LWLockTranche, LWLock since 10
+		if wait_type.startswith("LWLock"):
+			return "LWLock"
+		return wait_type if wait_type in self.classes else "Other"
+
+	# a failed attempt is repeated after 1, 2, 4... seconds, not every tick
+	def connect(self):
+		now = monotonic()
+		if now < self.reconnect:
+			return False
+		try:
+			self.con = self.db.connect(self.timeout)
+			cur = self.con.cursor()
+			try:
+				cur.execute(self.sql)
+			finally:
+				cur.close()
+			self.con.commit()
+		except psycopg2.Error:
+			self.drop()
+			self.reconnect = now + self.backoff
+			self.backoff = min(self.backoff * 2, ASH_RECONNECT_MAX)
+			raise
+		self.backoff = 1
+		return True
+
+	def drop(self):
+		if self.con is not None:
+			try:
+				self.con.close()
+			except psycopg2.Error:
+				pass
+			self.con = None
+
+	def sample(self):
+		if not self.con and not self.connect():
+			return
+		rows = DB.execute_fetchall(self.con, "EXECUTE pgstat_ash")
+		# pg_stat_activity is cached until the end of the transaction
+		self.con.commit()
+
+		counts = [0] * len(self.classes)
+		self.lock.acquire()
+		try:
+			for wait_type, wait_event, fp, text in rows:
+				cls = self.wait_class(wait_type)
+				counts[self.classes.index(cls)] += 1
+				key = (cls, wait_event)
+				self.events[key] = self.events.get(key, 0) + 1
+				if fp in self.queries:
+					self.queries[fp][0] += 1
+				else:
+					if len(self.queries) >= ASH_MAX_QUERIES:
+						self.forget_queries()
+					self.queries[fp] = [1, text]
+			self.seq += 1
+			self.ring.append((self.seq, counts))
+		finally:
+			self.lock.release()
+
+	# drop the rarely seen half, the busy queries survive
+	def forget_queries(self):
+		keep = sorted(self.queries.items(), key=lambda q: q[1][0], reverse=True)
+		self.queries = dict(keep[:ASH_MAX_QUERIES / 2])
+
+	def run(self):
+		ticker = Ticker(self.delay)
+		while not self.stopped.is_set():
+			try:
+				self.sample()
+			except psycopg2.Error, e:
+				self.errors += 1
+				logging.debug("ash: %s" % str(e))
+				# the transaction is aborted, EXECUTE fails until rolled back
+				if self.con is not None:
+					try:
+						if self.con.closed:
+							self.con = None
+						else:
+							self.con.rollback()
+					except psycopg2.Error:
+						self.drop()
+			ticker.wait()
+
+	def stop(self):
+		self.stopped.set()
+
+	# averages the samples taken since the previous call
+	def aggregate(self):
+		self.lock.acquire()
+		try:
+			new = [s[1] for s in self.ring if s[0] > self.seen]
+			self.seen = self.seq
+		finally:
+			self.lock.release()
+		for n, c in enumerate(self.classes):
+			self.store[c] = sum(s[n] for s in new) / float(len(new)) if new else 0
+
+	def write(self, f, top):
+		self.lock.acquire()
+		try:
+			samples = self.seq
+			total = float(sum(self.events.values())) or 1
+			events = sorted(self.events.items(), key=lambda e: e[1], reverse=True)[:top]
+			queries = sorted(self.queries.items(), key=lambda q: q[1][0], reverse=True)[:top]
+		finally:
+			self.lock.release()
+		if not samples:
+			print >> f, "no active session samples"
+			return
+		print >> f, "=" * 79
+		print >> f, "Active sessions: %d samples at %.0f Hz" % (samples, 1 / self.delay)
+		print >> f, "%-8s %-32s %8s %6s" % ("CLASS", "WAIT EVENT", "AAS", "%")
+		for (cls, event), n in events:
+			print >> f, "%-8s %-32s %8.2f %6.1f" % (cls, event, n / float(samples), 100 * n / total)
+		print >> f, ""
+		print >> f, "%-32s %8s %6s  %s" % ("QUERY", "AAS", "%", "TEXT")
+		for fp, (n, text) in queries:
+			print >> f, "%-32s %8.2f %6.1f  %s" % (fp, n / float(samples), 100 * n / total,
+				" ".join((text or "").split()))
+
+# Alert rules, checked on every tick:
+#   COUNTER > VALUE [for N]  - the value (or rate) is above VALUE N ticks in a row,
+#                              also <, >= and <=
+#   COUNTER dev K [for N]    - the value deviates more than K standard
+#                              deviations from its EWMA baseline
+# COUNTER is the title (LOCK, SEQ%), title/metric (PROC/idltxn) or the csv
+# name (locks.lock_cnt) of a counter. Each rule keeps a few numbers of state.
+ALERT_RE = re.compile(r"^\s*(\S+)\s+(>=|<=|>|<|dev)\s+(-?[0-9.]+)\s*(?:sigma)?(?:\s+for\s+(\d+)(?:\s+ticks?)?)?\s*$")
+ALERT_ALPHA = 0.1 # EWMA weight of the last sample for dev rules
+ALERT_WARMUP = 10 # ticks to learn the baseline before dev rules fire
+
+class PgStatAlertRule:
+	ops = {
+		">": lambda v, x: v > x,
+		"<": lambda v, x: v < x,
+		">=": lambda v, x: v >= x,
+		"<=": lambda v, x: v <= x,
+	}
+
+	def __init__(self, text):
+		m = ALERT_RE.match(text)
+		if not m:
+			raise ValueError("bad alert rule '%s', see --help" % text)
+		self.text = " ".join(text.split())
+		self.counter = m.group(1)
+		self.op = m.group(2)
+		self.value = float(m.group(3))
+		self.ticks = int(m.group(4) or 1)
+
+	# index of the counter the rule is about in ps.counters
+	def resolve(self, ps):
+		found = []
+		n = 0
+		for group in ps.groups:
+			for c in group[1]:
+				if self.counter in ("%s.%s" % (group[2], c.name()), c.name(), c.title, "%s/%s" % (c.title, c.metric)):
+					found.append((n, "%s/%s" % (c.title, c.metric)))
+				n += 1
+		if not found:
+			raise ValueError("alert rule '%s': no counter '%s' shown" % (self.text, self.counter))
+		if len(found) > 1:
+			raise ValueError("alert rule '%s': '%s' is ambiguous, use one of %s" % \
+				(self.text, self.counter, ", ".join(f[1] for f in found)))
+		return found[0][0]
+
+class PgStatAlertState:
+	def __init__(self, rule, idx):
+		self.rule = rule
+		self.idx = idx
+		self.hits = 0
+		self.firing = False
+		self.n = 0
+		self.mean = 0.0
+		self.var = 0.0
+
+	# returns True when the rule matches this tick
+	def match(self, v):
+		rule = self.rule
+		if rule.op != "dev":
+			return PgStatAlertRule.ops[rule.op](v, rule.value)
+		hit = self.n >= ALERT_WARMUP and abs(v - self.mean) > rule.value * math.sqrt(self.var)
+		if self.n == 0:
+			self.mean = v
+		d = v - self.mean
+		self.mean += ALERT_ALPHA * d
+		# outliers would widen the band at once, while the baseline still
+		# follows a lasting change and the rule resolves eventually
+		if not hit:
+			self.var = (1 - ALERT_ALPHA) * (self.var + ALERT_ALPHA * d * d)
+		self.n += 1
+		return hit
+
+	def update(self, v):
+		self.hits = self.hits + 1 if self.match(v) else 0
+		was = self.firing
+		self.firing = self.hits >= self.rule.ticks
+		return self.firing != was
+
+# The rules of one host. An event is reported when a rule starts and stops
+# firing: as a JSON line to opts.alert_log and to opts.alert_cmd, which is
+# run by the shell with PGSTAT_* variables describing the event.
+class PgStatAlerts:
+	def __init__(self, rules, ps, host=None):
+		self.host = host
+		self.states = [PgStatAlertState(r, r.resolve(ps)) for r in rules]
+		self.fields = []
+		for group in ps.groups:
+			self.fields += ["%s.%s" % (group[2], c.name()) for c in group[1]]
+		self.procs = []
+
+	# returns the indexes of the counters of the firing rules
+	def check(self, ps):
+		marks = set()
+		for st in self.states:
+			v = float(ps.counters[st.idx].get())
+			if st.update(v):
+				self.event(st, v, ps.snapshot.time)
+			if st.firing:
+				marks.add(st.idx)
+		self.procs = [p for p in self.procs if p.poll() is None]
+		return marks
+
+	def event(self, st, v, ts):
+		ev = OrderedDict()
+		ev["ts"] = ts
+		if self.host:
+			ev["host"] = self.host
+		ev["rule"] = st.rule.text
+		ev["counter"] = self.fields[st.idx]
+		ev["value"] = num(v)
+		ev["state"] = "firing" if st.firing else "resolved"
+		line = json.dumps(ev)
+		if opts.alert_log == "-":
+			print >> sys.stderr, line
+		else:
+			f = open(opts.alert_log, "a")
+			try:
+				f.write(line + "\n")
+			finally:
+				f.close()
+		if opts.alert_cmd:
+			env = dict(os.environ)
+			for k, val in ev.items():
+				env["PGSTAT_" + k.upper()] = str(val)
+			env["PGSTAT_EVENT"] = line
+			try:
+				# not waited for, a slow hook must not stall the polling
+				self.procs.append(subprocess.Popen(opts.alert_cmd, shell=True, env=env))
+			except OSError, e:
+				logging.warning("alert command failed: %s" % str(e))
+
+def make_alerts(ps, host=None):
+	if not opts.alert:
+		return None
+	return PgStatAlerts([PgStatAlertRule(r) for r in opts.alert], ps, host)
+
+# Chooses the poll interval from what is seen. It drops to opts.min_delay at
+# once when a rate jumps or an alarm counter (LOCK, idle in transaction) is
+# non-zero, and grows step by step up to opts.max_delay while all is quiet.
+# Whatever happens, the snapshot query takes at most ADAPTIVE_OVERHEAD of
+# the time, so a struggling server is polled less often.
+ADAPTIVE_OVERHEAD = 0.05
+
+class PgStatAdaptiveDelay:
+	alpha = 0.3 # EWMA weight of the last sample
+	jump = 4 # deviations from the mean to call a rate change sharp
+	grow = 1.5
+	quiet_ticks = 3 # ticks without changes before the interval grows
+
+	def __init__(self, ps):
+		self.ps = ps
+		self.delay = min(max(opts.delay, opts.min_delay), opts.max_delay)
+		self.mean = [None] * len(ps.counters)
+		self.dev = [0.0] * len(ps.counters)
+		self.quiet = 0
+
+	# counters whose value is far from the usual one, both in terms of its
+	# recent deviation and relatively, so noise around zero does not count
+	def volatile(self):
+		hot = []
+		for n, c in enumerate(self.ps.counters):
+			r = float(c.get())
+			m = self.mean[n]
+			if m is None:
+				self.mean[n] = r
+				continue
+			d = abs(r - m)
+			if d > self.jump * self.dev[n] and d > 0.5 * abs(m) and d >= 1:
+				hot.append(c)
+			self.mean[n] = m + self.alpha * (r - m)
+			self.dev[n] += self.alpha * (d - self.dev[n])
+		return hot
+
+	def update(self):
+		alarms = [c for c in self.ps.counters if c.alarm and c.get()]
+		hot = [c for c in self.volatile() if c not in alarms]
+		prev = self.delay
+		if alarms or hot:
+			self.delay = opts.min_delay
+			self.quiet = 0
+		else:
+			self.quiet += 1
+			if self.quiet >= self.quiet_ticks:
+				self.delay = min(self.delay * self.grow, opts.max_delay)
+		floor = self.ps.snapshot.cost / ADAPTIVE_OVERHEAD
+		if self.delay < floor:
+			self.delay = floor
+			why = "query took %.3f sec" % self.ps.snapshot.cost
+		elif alarms or hot:
+			why = ", ".join("%s %s" % (c.title, c.metric) for c in alarms + hot)
+		else:
+			why = "quiet"
+		if self.delay != prev:
+			logging.debug("poll interval %.2f -> %.2f sec: %s" % (prev, self.delay, why))
+		return self.delay
+
+def pg_usage(con, db):
+	pg_ver = PgVersion(con)
+	info(pg_ver.str)
+	ash = PgStatAsh(db, pg_ver, opts.ash_rate, opts.timeout) if opts.ash else None
+	ps = PgStats(con, pg_ver, ash=ash)
+	if ash:
+		ash.start()
+	rec = PgStatRecorder(opts.record, ps, pg_ver) if opts.record else None
+	summary = PgStatSummary(ps) if opts.summary or opts.summary_json else None
+	adaptive = PgStatAdaptiveDelay(ps) if opts.adaptive else None
+	alerts = make_alerts(ps)
+	lead_fmt = "%6s |" if adaptive else "%s"
+	out = make_output(ps)
+	if out:
+		out.header()
+	else:
+		ps.header(lead_fmt % ("INTVL" if adaptive else ""))
+	ticker = Ticker(adaptive.delay if adaptive else opts.delay)
 	ps.update()
+	if rec:
+		rec.write(ps.snapshot)
 	try:
 		i = 0
 		while True:
-			time.sleep(opts.delay)
+			ticker.wait()
 			ps.update()
-			ps.print_row()
+			if rec:
+				rec.write(ps.snapshot)
+			marks = alerts.check(ps) if alerts else ()
+			if out:
+				out.write(ps.snapshot.time, out.values(ps), interval=ps.snapshot.dt)
+			else:
+				ps.print_row(lead_fmt % ("%.2f" % ps.snapshot.dt if adaptive else ""), marks)
+			if adaptive:
+				ticker.delay = adaptive.update()
+			if summary:
+				summary.add(ps)
+			if opts.count:
+				i += 1
+				if opts.count <= i:
+					break
+	except KeyboardInterrupt, e:
+		pass
+	if rec:
+		rec.close()
+	if ash:
+		ash.stop()
+		ash.write(sys.stdout if opts.format == "text" else sys.stderr, opts.ash_top)
+	if summary:
+		print_summary(summary)
+
+per_db_cols_def = [
+	# title     #sql_name        #since  #help
+	("COMMIT",   "xact_commit",   (8, 0), "committed transactions"),
+	("RLLBCK",   "xact_rollback", (8, 0), "rolled back transactions"),
+	("HIT",      "blks_hit",      (8, 0), "shmem block hits"),
+	("MISS",     "blks_read",     (8, 0), "shmem block misses"),
+	("RET",      "tup_returned",  (8, 3), "rows returned by seq scans and index scans"),
+	("FETCH",    "tup_fetched",   (8, 3), "rows fetched by index scans"),
+	("INS",      "tup_inserted",  (8, 3), "rows inserted"),
+	("UPD",      "tup_updated",   (8, 3), "rows updated"),
+	("DEL",      "tup_deleted",   (8, 3), "rows deleted"),
+	("DEADLOCK", "deadlocks",     (9, 2), "deadlocks"),
+	("TEMPKB",   "temp_bytes",    (9, 2), "kilobytes written to temporary files"),
+]
+
+PER_DB_HIT_PCT = "HIT%"
+
+# Per-database rates from a single fetch of pg_stat_database per tick. The
+# columns are kept as arrays ordered by datid, so as long as no database is
+# created or dropped the deltas are a plain loop over each column, without
+# any per-database lookups.
+class PgStatPerDb:
+	def __init__(self, con, pg_ver):
+		self.cols = [c for c in per_db_cols_def if pg_ver.ge(*c[2])]
+		self.titles = [c[0] for c in self.cols] + [PER_DB_HIT_PCT]
+		self.store = PgStatStorePerDb([c[1] for c in self.cols], pg_ver)
+		self.snapshot = PgStatSnapshot(con, pg_ver)
+		self.snapshot.add(self.store)
+		self.prev = None
+		self.rows = []
+		self.total = None
+
+	def update(self):
+		self.snapshot.update()
+		st = self.store.store
+		ts = self.snapshot.time
+		ids = st["datid"]
+		reset = st["stats_reset"]
+		vals = [array.array("d", st[c[1]]) for c in self.cols]
+
+		if self.prev is None:
+			self.prev = (ts, ids, reset, vals)
+			return False
+		prev_ts, prev_ids, prev_reset, prev_vals = self.prev
+		self.prev = (ts, ids, reset, vals)
+
+		if ids != prev_ids:
+			# databases were created or dropped, align the previous sample
+			pos = dict(zip(prev_ids, xrange(0, len(prev_ids))))
+			idx = [pos.get(i) for i in ids]
+			prev_vals = [array.array("d", [p[n] if n is not None else v for n, v in zip(idx, cur)])
+				for p, cur in zip(prev_vals, vals)]
+			prev_reset = [prev_reset[n] if n is not None else r for n, r in zip(idx, reset)]
+
+		dt = ts - prev_ts
+		if not dt:
+			# the server has not refreshed its statistics yet, keep the last rates
+			return self.total is not None
+		deltas = [[c - p for c, p in zip(cur, prev)] for cur, prev in zip(vals, prev_vals)]
+
+		# a stats reset of a database drops its counters, skip it for this interval
+		resets = [r != pr for r, pr in zip(reset, prev_reset)]
+		for d in deltas:
+			for n in xrange(0, len(d)):
+				if d[n] < 0:
+					resets[n] = True
+		reset_idx = [n for n in xrange(0, len(resets)) if resets[n]]
+		for d in deltas:
+			for n in reset_idx:
+				d[n] = 0
+
+		rates = [[x / dt for x in d] for d in deltas]
+		hit, miss = deltas[self.titles.index("HIT")], deltas[self.titles.index("MISS")]
+		rates.append([100.0 * h / (h + m) if h + m else 0.0 for h, m in zip(hit, miss)])
+
+		if "TEMPKB" in self.titles:
+			n = self.titles.index("TEMPKB")
+			rates[n] = [r / 1024 for r in rates[n]]
+
+		self.rows = zip(st["datname"], zip(*rates), resets)
+		sums = [sum(r) for r in rates[:-1]]
+		sum_hit, sum_miss = sum(hit), sum(miss)
+		self.total = sums + [100.0 * sum_hit / (sum_hit + sum_miss) if sum_hit + sum_miss else 0.0]
+		return True
+
+	def top(self, title, n):
+		col = self.titles.index(title)
+		return sorted(self.rows, key=lambda r: r[1][col], reverse=True)[:n]
+
+def pg_per_db_usage(con):
+	pg_ver = PgVersion(con)
+	info(pg_ver.str)
+	pd = PgStatPerDb(con, pg_ver)
+	if opts.per_db_sort not in pd.titles:
+		raise ValueError("%s counter is not available on this server" % opts.per_db_sort)
+
+	width = [max(len(t) + 2, 8) for t in pd.titles]
+	name_w = 24
+	fmt = "%%-%ds" % name_w + "".join([" %%%ds" % w for w in width])
+	titles = [t if t == PER_DB_HIT_PCT else t + "/s" for t in pd.titles]
+	keys = [re.sub("[^a-z0-9]+", "_", t.lower().replace("%", "_pct")).strip("_") for t in pd.titles]
+
+	w = None
+	if opts.format == "csv":
+		w = csv.writer(sys.stdout, lineterminator="\n")
+		w.writerow(["ts", "datname", "reset"] + keys)
+
+	def fmt_rate(r):
+		return ("%.1f" if r < 100 else "%.0f") % r
+
+	ticker = Ticker(opts.delay)
+	pd.update()
+	try:
+		i = 0
+		while True:
+			ticker.wait()
+			if not pd.update():
+				continue
+			ts = pd.snapshot.time
+			rows = pd.top(opts.per_db_sort, opts.per_db_top) + [("TOTAL", pd.total, False)]
+			if opts.format == "text":
+				print "%s %s sorted by %s" % ("=" * 8, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)),
+					opts.per_db_sort)
+				print fmt % tuple(["DATABASE"] + titles)
+				for name, rates, reset in rows:
+					name = name + ("*" if reset else "")
+					if len(name) > name_w:
+						name = name[0:name_w - 3] + "..."
+					print fmt % tuple([name] + [fmt_rate(r) for r in rates])
+			else:
+				for name, rates, reset in rows:
+					if w:
+						w.writerow([repr(ts), name, int(reset)] + [repr(r) for r in rates])
+					else:
+						rec = OrderedDict()
+						rec["ts"] = ts
+						rec["datname"] = name
+						rec["reset"] = reset
+						for k, r in zip(keys, rates):
+							rec[k] = r
+						sys.stdout.write(json.dumps(rec) + "\n")
+			sys.stdout.flush()
+			if opts.count:
+				i += 1
+				if opts.count <= i:
+					break
+	except KeyboardInterrupt, e:
+		pass
+
+def parse_time(s):
+	try:
+		return float(s)
+	except ValueError:
+		pass
+	for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+		try:
+			return time.mktime(time.strptime(s, fmt))
+		except ValueError:
+			pass
+	raise ValueError("bad time '%s', use epoch seconds or 'YYYY-mm-dd HH:MM:SS'" % s)
+
+# Feeds the samples of a recording through the counters as if they were
+# just fetched from the server
+def pg_replay(fname):
+	rec = PgStatRecording(fname)
+	pg_ver = PgVersion(num=rec.meta["version_num"], version_str=rec.meta["version"])
+	info(pg_ver.str)
+	opts.scan_threshold = rec.meta["scan_threshold"]
+	ps = PgStats(None, pg_ver, groups=rec.meta.get("groups", default_groups()))
+	summary = PgStatSummary(ps) if opts.summary or opts.summary_json else None
+	alerts = make_alerts(ps)
+	out = make_output(ps)
+
+	# map the columns of the current layout onto the recorded ones
+	cols = []
+	for k in ps.snapshot.keys():
+		if k in rec.keys:
+			cols.append(rec.keys.index(k) + 1)
+		else:
+			logging.warning("%s is not recorded in %s" % (k, fname))
+			cols.append(None)
+
+	start = rec.find(parse_time(opts.replay_from)) if opts.replay_from else 0
+	stop = rec.find(parse_time(opts.replay_to)) if opts.replay_to else len(rec)
+	lead_fmt = "%19s |"
+	if out:
+		out.header()
+	else:
+		ps.header(lead_fmt % "TIME")
+
+	try:
+		i = 0
+		prev_ts = None
+		for n in xrange(start, stop):
+			r = rec[n]
+			ts = r[0]
+			if prev_ts is not None and ts - prev_ts < opts.replay_step:
+				continue
+			if opts.replay_speed:
+				if prev_ts is None:
+					t0, ts0 = monotonic(), ts
+				else:
+					left = t0 + (ts - ts0) / opts.replay_speed - monotonic()
+					if left > 0:
+						time.sleep(left)
+			ps.snapshot.load(ts, [r[c] if c else 0 for c in cols])
+			ps.update_counters()
+			if prev_ts is not None:
+				marks = alerts.check(ps) if alerts else ()
+				if out:
+					out.write(ts, out.values(ps))
+				else:
+					ps.print_row(lead_fmt % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)), marks)
+				if summary:
+					summary.add(ps)
+				if opts.count:
+					i += 1
+					if opts.count <= i:
+						break
+			prev_ts = ts
+	except KeyboardInterrupt, e:
+		pass
+	rec.close()
+	if summary:
+		print_summary(summary)
+
+class PgStatHost:
+	def __init__(self, db, timeout):
+		self.db = db
+		self.name = db.get_host()
+		self.timeout = timeout
+		self.con = None
+		self.ver = None
+		self.ps = None
+		self.job = None
+		self.error = None
+
+	def connect(self):
+		try:
+			self.con = self.db.connect(self.timeout)
+			cur = self.con.cursor()
+			try:
+				# let the server give up on its own when the poll is late
+				cur.execute("SET statement_timeout = %d" % int(self.timeout * 1000))
+			finally:
+				cur.close()
+			self.con.commit()
+			self.ver = PgVersion(self.con)
+			self.error = None
+		except psycopg2.Error, e:
+			self.set_error(e)
+
+	def poll(self, layout_ver=None):
+		if not self.con:
+			self.connect()
+			if not self.con:
+				return
+		try:
+			if not self.ps:
+				self.ps = PgStats(self.con, self.ver, layout_ver)
+			self.ps.update()
+			self.error = None
+		except psycopg2.Error, e:
+			self.set_error(e)
+
+	def set_error(self, e):
+		self.error = str(e).strip().split("\n")[0] or type(e).__name__
+		logging.debug("%s: %s" % (self.name, str(e)))
+		if self.con is not None and self.con.closed:
+			self.con = None
+			self.ps = None
+
+	def start(self, pool, fn, *args):
+		# a host still busy with the previous poll is left alone
+		if self.job is None or self.job.ready():
+			self.job = pool.apply_async(fn, args)
+
+	def done(self):
+		return self.job is not None and self.job.ready()
+
+
+# Polls several clusters concurrently and prints one row per host per tick.
+# Each host is given at most opts.timeout, so a slow or unreachable server
+# does not delay the others.
+def pg_fleet_usage(dbs):
+	hosts = [PgStatHost(db, opts.timeout) for db in dbs]
+	names = [h.name for h in hosts]
+	for h in hosts:
+		if names.count(h.name) > 1:
+			h.name = "%s/%s" % (h.name, h.db.get_name())
+
+	pool = ThreadPool(len(hosts))
+
+	def wait_all():
+		deadline = monotonic() + opts.timeout
+		for h in hosts:
+			left = deadline - monotonic()
+			if h.job is not None and left > 0:
+				h.job.wait(left)
+
+	for h in hosts:
+		info("Connecting to %s ..." % str(h.db))
+		h.start(pool, h.connect)
+	wait_all()
+
+	vers = [h.ver for h in hosts if h.done() and h.ver]
+	if not vers:
+		for h in hosts:
+			info("%s: %s" % (h.name, h.error or "timeout"))
+		return
+	layout_ver = min(vers, key=lambda v: v.num)
+	for h in hosts:
+		info("%s: %s" % (h.name, h.ver.str if h.done() and h.ver else (h.error or "timeout")))
+
+	ticker = Ticker(opts.delay)
+	for h in hosts:
+		h.start(pool, h.poll, layout_ver)
+	wait_all()
+
+	ps = PgStats(None, layout_ver)
+	summary = None
+	if opts.summary or opts.summary_json:
+		summary = OrderedDict((h.name, PgStatSummary(ps)) for h in hosts)
+	alerts = dict((h.name, make_alerts(ps, h.name)) for h in hosts)
+	out = make_output(ps, fleet=True)
+	name_w = max([len(h.name) for h in hosts] + [len("TOTAL")])
+	lead_fmt = "%%8s %%-%ds |" % name_w
+	if opts.delay < 1:
+		lead_fmt = "%%12s %%-%ds |" % name_w
+	if out:
+		out.header()
+	else:
+		ps.header(lead_fmt % ("TIME", "HOST"))
+
+	try:
+		i = 0
+		while True:
+			ticker.wait()
+			t = time.time()
+			stamp = time.strftime("%H:%M:%S", time.localtime(t))
+			if opts.delay < 1:
+				stamp += ".%03d" % int((t % 1) * 1000)
+
+			for h in hosts:
+				h.start(pool, h.poll, layout_ver)
+			wait_all()
+
+			fresh = []
+			for h in hosts:
+				lead = lead_fmt % (stamp, h.name)
+				if not h.done():
+					error = "timeout"
+				elif h.error or not h.ps:
+					error = h.error or "not connected"
+				else:
+					error = None
+					fresh.append(h.ps)
+					if summary:
+						summary[h.name].add(h.ps)
+					marks = alerts[h.name].check(h.ps) if alerts[h.name] else ()
+
+				if out and error:
+					out.write(t, None, h.name, error)
+				elif out:
+					out.write(h.ps.snapshot.time, out.values(h.ps), h.name)
+				elif error:
+					print lead + " -- " + error
+				else:
+					h.ps.print_row(lead, marks)
+
+			if opts.total and fresh:
+				vals = []
+				for n in xrange(0, len(ps.counters)):
+					cs = [p.counters[n] for p in fresh]
+					if opts.abs:
+						vals.append(sum([c.abs() for c in cs]))
+					else:
+						r = sum([c.get() for c in cs])
+						if cs[0].aggregate == "avg":
+							r /= float(len(cs))
+						vals.append(r)
+				if out:
+					out.write(t, [num(v) for v in vals], "TOTAL")
+				else:
+					vals = ["%d" % v if opts.abs else c.format(v) for c, v in zip(ps.counters, vals)]
+					print lead_fmt % (stamp, "TOTAL") + ps.fmt % tuple(vals)
+			sys.stdout.flush()
+
 			if opts.count:
 				i += 1
 				if opts.count <= i:
 					break
 	except KeyboardInterrupt, e:
 		pass
+	if summary:
+		print_summary(summary)
+
+# Serves the last sample in Prometheus text format. Whatever the number of
+# scrapers, the database is polled at most once per opts.min_refresh: the
+# first request after that interval polls, the concurrent ones wait for it
+# and get the same result.
+class PgStatCache:
+	def __init__(self, host, min_refresh):
+		self.host = host
+		self.min_refresh = min_refresh
+		self.lock = threading.Lock()
+		self.polled = None
+		self.text = None
+
+	def get(self):
+		self.lock.acquire()
+		try:
+			now = monotonic()
+			if self.text is None or now - self.polled >= self.min_refresh:
+				self.host.poll()
+				self.polled = now
+				self.text = self.render(monotonic() - now)
+			return self.text
+		finally:
+			self.lock.release()
+
+	def render(self, duration):
+		out = []
+		def metric(name, mtype, help, val):
+			out.append("# HELP pgstat_%s %s" % (name, help.replace("\\", "\\\\")))
+			out.append("# TYPE pgstat_%s %s" % (name, mtype))
+			out.append("pgstat_%s %s" % (name, repr(float(val))))
+
+		ps = self.host.ps
+		metric("up", "gauge", "whether the last poll of the database succeeded",
+			0 if self.host.error or not ps else 1)
+		metric("poll_duration_seconds", "gauge", "duration of the last poll", duration)
+		if ps and not self.host.error:
+			metric("snapshot_timestamp_seconds", "gauge", "time of the statistics snapshot", ps.snapshot.time)
+			for c in ps.counters:
+				if c.absolute:
+					metric(c.name(), "gauge", c.help, c.val)
+				elif c.gauge:
+					metric(c.name(), "gauge", c.help, c.val)
+					metric(c.name() + "_rate", "gauge", "%s, change per second" % c.help, c.rate)
+				else:
+					metric(c.name() + "_total", "counter", c.help, c.val)
+					metric(c.name() + "_rate", "gauge", "%s, per second" % c.help, c.rate)
+		return "\n".join(out) + "\n"
+
+class PgStatHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split("?")[0] not in ("/", "/metrics"):
+			self.send_error(404)
+			return
+		text = self.server.cache.get()
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(text)))
+		self.end_headers()
+		self.wfile.write(text)
+
+	def log_message(self, fmt, *args):
+		logging.debug("%s - %s" % (self.client_address[0], fmt % args))
+
+class PgStatHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+def pg_listen(db, addr):
+	host = PgStatHost(db, opts.timeout)
+	info("Connecting to %s ..." % str(db))
+	host.connect()
+	info(host.ver.str if host.ver else host.error)
+
+	server = PgStatHTTPServer(addr, PgStatHTTPHandler)
+	server.cache = PgStatCache(host, opts.min_refresh)
+	print "Serving metrics on http://%s:%d/metrics" % (addr[0] or "0.0.0.0", addr[1])
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt, e:
+		pass
+
+# Rollup daemon: samples are stored in DIR as gzip-compressed JSON lines
+# segments, one series per resolution. Each segment starts with a header
+# record naming the counters, its name tells the time range it covers
+# (LEVEL-FIRST.jsonl.gz while written, LEVEL-FIRST-LAST.jsonl.gz once
+# closed), so a query opens only the segments it needs. A segment is closed
+# when its compressed size reaches opts.segment_kb or it spans 1/8 of the
+# retention of its level, and removed when its last sample expires.
+ROLLUP_LEVELS = [
+	# name #period, sec #retention option
+	("raw", None,        "keep_raw"),
+	("1m",  60,          "keep_1m"),
+	("1h",  3600,        "keep_1h"),
+]
+SEGMENT_SUFFIX = ".jsonl.gz"
+
+def parse_duration(s):
+	units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+	try:
+		if s[-1:] in units:
+			return float(s[:-1]) * units[s[-1]]
+		return float(s)
+	except ValueError:
+		raise ValueError("bad duration '%s', use seconds or a number with s, m, h or d suffix" % s)
+
+# Segments of a level as (first, last, path), last is None for the one being
+# written, ordered by time
+def list_segments(dirname, level):
+	segs = []
+	for fname in os.listdir(dirname):
+		if not fname.startswith(level + "-") or not fname.endswith(SEGMENT_SUFFIX):
+			continue
+		span = fname[len(level) + 1:-len(SEGMENT_SUFFIX)].split("-")
+		try:
+			first = int(span[0])
+			last = int(span[1]) if len(span) > 1 else None
+		except ValueError:
+			continue
+		segs.append((first, last, os.path.join(dirname, fname)))
+	segs.sort()
+	return segs
+
+# Yields the records of a segment. The segment being written has no gzip
+# trailer yet, so it is decompressed chunk by chunk rather than by GzipFile,
+# and a tail cut by a crash is ignored.
+def read_segment(path):
+	f = open(path, "rb")
+	try:
+		d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		buf = ""
+		while True:
+			chunk = f.read(65536)
+			if not chunk:
+				break
+			try:
+				buf += d.decompress(chunk)
+			except zlib.error, e:
+				logging.debug("%s: %s" % (path, str(e)))
+				break
+			lines = buf.split("\n")
+			buf = lines.pop()
+			for line in lines:
+				yield json.loads(line)
+	finally:
+		f.close()
+
+class PgStatSegmentWriter:
+	def __init__(self, dirname, level, keep):
+		self.dirname = dirname
+		self.level = level
+		self.keep = keep
+		self.max_span = keep / 8
+		self.f = None
+		self.raw = None
+		self.path = None
+		self.fields = None
+		self.first = None
+		self.last = None
+		self.recover()
+
+	# closes segments left open by a crash or a kill -9
+	def recover(self):
+		for first, last, path in list_segments(self.dirname, self.level):
+			if last is not None:
+				continue
+			for rec in read_segment(path):
+				if "ts" in rec:
+					last = rec["ts"]
+			if last is None:
+				os.remove(path)
+			else:
+				os.rename(path, self.segment_path(first, last))
+
+	# the span is widened to whole seconds, so a name never cuts off a record
+	def segment_path(self, first, last=None):
+		fname = "%s-%d" % (self.level, math.floor(first))
+		if last is not None:
+			fname += "-%d" % math.ceil(last)
+		return os.path.join(self.dirname, fname + SEGMENT_SUFFIX)
+
+	def write(self, header, rec):
+		if self.f and (header["fields"] != self.fields or \
+				self.raw.tell() >= opts.segment_kb * 1024 or rec["ts"] - self.first >= self.max_span):
+			self.close()
+		if not self.f:
+			self.first = rec["ts"]
+			self.fields = header["fields"]
+			self.path = self.segment_path(self.first)
+			self.raw = open(self.path, "wb")
+			self.f = gzip.GzipFile(filename="", mode="wb", fileobj=self.raw)
+			self.f.write(json.dumps(header) + "\n")
+		self.f.write(json.dumps(rec) + "\n")
+		# a sync point per record keeps the segment readable while written
+		self.f.flush()
+		self.last = rec["ts"]
+
+	def close(self):
+		if not self.f:
+			return
+		self.f.close()
+		self.raw.close()
+		os.rename(self.path, self.segment_path(self.first, self.last))
+		self.f = None
+
+	def expire(self, now):
+		for first, last, path in list_segments(self.dirname, self.level):
+			if last is not None and last < now - self.keep:
+				logging.debug("removing expired %s" % path)
+				os.remove(path)
+
+# Running min/max/avg/last of every counter over aligned periods
+class PgStatRollup:
+	def __init__(self, period):
+		self.period = period
+		self.start = None
+
+	# returns the record of the previous period once a sample of the next
+	# one comes
+	def add(self, ts, vals):
+		start = int(ts // self.period) * self.period
+		done = None
+		if self.start is not None and start != self.start:
+			done = self.flush()
+		if self.start is None:
+			self.start = start
+			self.n = 0
+			self.min = list(vals)
+			self.max = list(vals)
+			self.sum = [0.0] * len(vals)
+		self.n += 1
+		for i, v in enumerate(vals):
+			self.min[i] = min(self.min[i], v)
+			self.max[i] = max(self.max[i], v)
+			self.sum[i] += v
+		self.last = list(vals)
+		return done
+
+	def flush(self):
+		if self.start is None:
+			return None
+		rec = OrderedDict()
+		rec["ts"] = self.start
+		rec["n"] = self.n
+		rec["min"] = self.min
+		rec["max"] = self.max
+		rec["avg"] = [s / self.n for s in self.sum]
+		rec["last"] = self.last
+		self.start = None
+		return rec
+
+def pg_daemon(db, dirname):
+	if not os.path.isdir(dirname):
+		os.makedirs(dirname)
+	writers = [PgStatSegmentWriter(dirname, level, parse_duration(getattr(opts, keep)))
+		for level, period, keep in ROLLUP_LEVELS]
+	rollups = [PgStatRollup(period) if period else None for level, period, keep in ROLLUP_LEVELS]
+
+	# let kill and service managers stop the daemon cleanly
+	def terminate(signum, frame):
+		raise KeyboardInterrupt()
+	signal.signal(signal.SIGTERM, terminate)
+
+	host = PgStatHost(db, opts.timeout)
+	ticker = Ticker(opts.delay)
+	header = None
+	alerts = None
+	error = None
+	expired = 0
+	try:
+		i = 0
+		while True:
+			try:
+				host.poll()
+				if host.error != error:
+					if host.error:
+						logging.warning("%s: %s" % (host.name, host.error))
+					else:
+						logging.warning("%s: %s" % (host.name, host.ver.str))
+					error = host.error
+				ps = host.ps
+				# the first sample after (re)connect has no rates
+				if ps and not host.error and ps.snapshot.dt:
+					fields = []
+					for group in ps.groups:
+						fields += ["%s.%s" % (group[2], c.name()) for c in group[1]]
+					if not header or header["fields"] != fields:
+						for w, r in zip(writers, rollups):
+							rec = r and r.flush()
+							if rec:
+								w.write(header, rec)
+						header = OrderedDict([("host", host.name), ("version", ps.server_ver.str), ("fields", fields)])
+						alerts = make_alerts(ps, host.name)
+					if alerts:
+						alerts.check(ps)
+
+					ts = ps.snapshot.time
+					vals = [float(c.get()) for c in ps.counters]
+					for w, r in zip(writers, rollups):
+						rec = r.add(ts, vals) if r else OrderedDict([("ts", ts), ("v", vals)])
+						if rec:
+							w.write(header, rec)
+
+					if ts - expired >= 60:
+						for w in writers:
+							w.expire(ts)
+						expired = ts
+			except Exception:
+				# a bad sample or a full disk must not stop the daemon
+				logging.exception("%s: poll failed" % host.name)
+			if opts.count:
+				i += 1
+				if opts.count <= i:
+					break
+			ticker.wait()
+	except KeyboardInterrupt, e:
+		pass
+	# keep the partial periods, the query merges them with the rest
+	for w, r in zip(writers, rollups):
+		rec = r and r.flush()
+		if rec:
+			w.write(header, rec)
+		w.close()
+
+# Merges records of the same period written by several daemon runs
+def merge_rollup(a, b):
+	n = a["n"] + b["n"]
+	return OrderedDict([
+		("ts", a["ts"]),
+		("n", n),
+		("min", map(min, a["min"], b["min"])),
+		("max", map(max, a["max"], b["max"])),
+		("avg", [(x * a["n"] + y * b["n"]) / n for x, y in zip(a["avg"], b["avg"])]),
+		("last", b["last"]),
+	])
+
+# Prints the records of a level within [opts.query_from, opts.query_to]
+def pg_query(dirname):
+	level = opts.resolution
+	t_from = parse_time(opts.query_from) if opts.query_from else 0
+	t_to = parse_time(opts.query_to) if opts.query_to else float("inf")
+	stats = ["min", "max", "avg", "last"]
+	w = csv.writer(sys.stdout, lineterminator="\n")
+
+	def records():
+		prev = None
+		for first, last, path in list_segments(dirname, level):
+			# the older names have the last second cut, not rounded up
+			if first > t_to or (last is not None and last + 1 <= t_from):
+				continue
+			fields = None
+			for rec in read_segment(path):
+				if "fields" in rec:
+					fields = rec["fields"]
+					continue
+				if rec["ts"] < t_from:
+					continue
+				if rec["ts"] > t_to:
+					break
+				if prev and prev[1]["ts"] == rec["ts"] and prev[0] == fields and level != "raw":
+					prev = (fields, merge_rollup(prev[1], rec))
+					continue
+				if prev:
+					yield prev
+				prev = (fields, rec)
+		if prev:
+			yield prev
+
+	fields = None
+	for rec_fields, rec in records():
+		if opts.format == "jsonl":
+			out = OrderedDict([("ts", rec["ts"])])
+			if level == "raw":
+				for f, v in zip(rec_fields, rec["v"]):
+					g, c = f.split(".", 1)
+					out.setdefault(g, OrderedDict())[c] = v
+			else:
+				out["n"] = rec["n"]
+				for n, f in enumerate(rec_fields):
+					g, c = f.split(".", 1)
+					out.setdefault(g, OrderedDict())[c] = OrderedDict((s, rec[s][n]) for s in stats)
+			sys.stdout.write(json.dumps(out) + "\n")
+			continue
+
+		# csv, with a new header whenever the counters change
+		if rec_fields != fields:
+			fields = rec_fields
+			if level == "raw":
+				w.writerow(["ts"] + fields)
+			else:
+				w.writerow(["ts", "n"] + ["%s.%s" % (f, s) for f in fields for s in stats])
+		if level == "raw":
+			w.writerow([repr(rec["ts"])] + [repr(v) for v in rec["v"]])
+		else:
+			w.writerow([rec["ts"], rec["n"]] + [repr(rec[s][n]) for n in xrange(0, len(fields)) for s in stats])
 
 def main():
 	global opts
-	global con
 
 	test_description = "%prog [options]"
 
@@ -441,17 +2661,126 @@ def main():
 		if inspect.isclass(obj) and issubclass(obj, DbStatCounter) and hasattr(obj, "title"):
 			epilog += "\n%18s - %s" % (obj.title + " (" + obj.metric + ")", obj.help)
 
+	epilog += "\n\nCounter groups (--groups):"
+	for g in counter_groups:
+		epilog += "\n%18s - %s%s" % (g.name, g.help, "" if g.default else " (not shown by default)")
+
+	epilog += "\n\nPer-database counters (--per-db):"
+	for c in per_db_cols_def:
+		epilog += "\n%18s - %s per second [pg_stat_database.%s]" % (c[0], c[3], c[1])
+	epilog += "\n%18s - %s" % (PER_DB_HIT_PCT, "percentage of shmem block hits in the interval")
+
 	class PgOptParser(OptionParser):
 		def format_epilog(self, formatter):
 			return self.epilog + "\n"
 
 	p = PgOptParser(test_description, epilog=epilog)
 	p.add_option("-v", "--verbose", action="store_true", help="enable verbose mode")
-	p.add_option("-d", "--delay",   type=int, default=2, help="delay between database poll (sec)")
+	p.add_option("-d", "--delay",   type=float, default=2, help="delay between database poll (sec, >= %s)" % MIN_DELAY)
 	p.add_option("-n", "--count",   type=int, default=0, help="exit after COUNT iterations")
 	p.add_option("-a", "--abs",     action="store_true", help="show absolute values, not rates")
+	p.add_option("-f", "--format",  type="choice", default="text", choices=("text", "csv", "jsonl"),
+		help="output format: text, csv or jsonl (one JSON object per line) [default: %default]")
 	p.add_option("-r", "--scan-threshold", type=int, default=5000,
 		help="skip tables with fewer rows when collect IDX and SEQ scan stats")
+	p.add_option("", "--scan-refresh", type=float, default=600, metavar="SEC",
+		help="look for the tables with more rows than the scan threshold every SEC, "
+			"and when tables are created, dropped or cross the threshold [default: %default]")
+	p.add_option("-g", "--groups",  type="string", default="default",
+		help="comma-separated counter groups to show, 'default' and 'all' can be used as well "
+			"[default: %default]")
+	p.add_option("", "--adaptive",  action="store_true",
+		help="vary the delay between --min-delay and --max-delay: shorter when rates change "
+			"sharply or LOCK/idle in transaction are non-zero, longer when the database is quiet")
+	p.add_option("", "--min-delay", type=float, default=None, metavar="SEC",
+		help="shortest adaptive delay [default: delay/4]")
+	p.add_option("", "--max-delay", type=float, default=None, metavar="SEC",
+		help="longest adaptive delay [default: 5*delay]")
+	p.add_option("-s", "--summary", action="store_true",
+		help="print min, max, mean, stddev, percentiles and total change of every counter at exit")
+	p.add_option("", "--summary-json", type="string", metavar="FILE",
+		help="write the summary as JSON to FILE, '-' for stdout")
+
+	g = OptionGroup(p, "Active sessions")
+	g.add_option("", "--ash",       action="store_true",
+		help="sample pg_stat_activity in a separate connection, show average active sessions "
+			"by wait class and top wait events and queries at exit")
+	g.add_option("", "--ash-rate",  type=float, default=20, metavar="HZ",
+		help="samples per second, up to 100 [default: %default]")
+	g.add_option("", "--ash-top",   type=int, default=10, metavar="N",
+		help="wait events and queries to show at exit [default: %default]")
+	p.add_option_group(g)
+
+	g = OptionGroup(p, "Alerts")
+	g.add_option("", "--alert",     action="append", default=[], metavar="RULE",
+		help="report when RULE fires, may be repeated. RULE is 'COUNTER OP VALUE [for N]' "
+			"with OP one of >, <, >=, <=, e.g. 'LOCK > 5 for 3', or 'COUNTER dev K [for N]' "
+			"for a deviation of K sigmas from the usual, e.g. 'COMMIT dev 4'. COUNTER is "
+			"a title, title/metric or csv name of a counter. Cells of firing rules are highlighted")
+	g.add_option("", "--alert-cmd", type="string", metavar="CMD",
+		help="run CMD by the shell when a rule fires or resolves, "
+			"with the event in PGSTAT_RULE, PGSTAT_VALUE, PGSTAT_STATE etc.")
+	g.add_option("", "--alert-log", type="string", default="-", metavar="FILE",
+		help="append events as JSON lines to FILE, '-' for stderr [default: %default]")
+	p.add_option_group(g)
+
+	g = OptionGroup(p, "Per-database breakdown")
+	g.add_option("", "--per-db",    action="store_true",
+		help="show top databases of the cluster instead of the cluster-wide counters")
+	g.add_option("", "--per-db-sort", type="choice", default="COMMIT",
+		choices=tuple([c[0] for c in per_db_cols_def] + [PER_DB_HIT_PCT]),
+		help="sort databases by given counter: %s [default: %%default]" % \
+			", ".join([c[0] for c in per_db_cols_def] + [PER_DB_HIT_PCT]))
+	g.add_option("", "--per-db-top", type=int, default=10, metavar="N",
+		help="show N busiest databases [default: %default]")
+	p.add_option_group(g)
+
+	g = OptionGroup(p, "Several clusters")
+	g.add_option("-D", "--dsn",     action="append", default=[],
+		help="libpq connection string of a cluster to poll, may be repeated")
+	g.add_option("", "--timeout",   type=float, default=None,
+		help="per-host poll timeout (sec) [default: 90% of delay]")
+	g.add_option("", "--total",     action="store_true", help="print fleet-total row")
+	p.add_option_group(g)
+
+	g = OptionGroup(p, "Exporter")
+	g.add_option("", "--listen",    type="string", metavar="ADDR:PORT",
+		help="serve counters in Prometheus text format on ADDR:PORT instead of printing them")
+	g.add_option("", "--min-refresh", type=float, default=None, metavar="SEC",
+		help="poll the database at most once per SEC whatever the number of scrapes [default: delay]")
+	p.add_option_group(g)
+
+	g = OptionGroup(p, "Recording")
+	g.add_option("", "--record",    type="string", metavar="FILE", help="append raw samples to FILE")
+	g.add_option("", "--replay",    type="string", metavar="FILE", help="show samples recorded in FILE")
+	g.add_option("", "--replay-speed", type=float, default=0,
+		help="replay at given speed-up, 0 - as fast as possible [default: %default]")
+	g.add_option("", "--replay-from", type="string", metavar="TIME",
+		help="skip samples before TIME (epoch or 'YYYY-mm-dd HH:MM:SS')")
+	g.add_option("", "--replay-to", type="string", metavar="TIME", help="stop at TIME")
+	g.add_option("", "--replay-step", type=float, default=0, metavar="SEC",
+		help="print a row every SEC of recorded time at most [default: every sample]")
+	p.add_option_group(g)
+
+	g = OptionGroup(p, "Rollup daemon")
+	g.add_option("", "--daemon",    type="string", metavar="DIR",
+		help="do not print anything, store samples and their 1 minute and 1 hour rollups in DIR")
+	g.add_option("", "--keep-raw",  type="string", default="1h", metavar="TIME",
+		help="keep samples for TIME (seconds or with s, m, h, d suffix) [default: %default]")
+	g.add_option("", "--keep-1m",   type="string", default="7d", metavar="TIME",
+		help="keep 1 minute rollups for TIME [default: %default]")
+	g.add_option("", "--keep-1h",   type="string", default="365d", metavar="TIME",
+		help="keep 1 hour rollups for TIME [default: %default]")
+	g.add_option("", "--segment-kb", type=int, default=1024, metavar="KB",
+		help="start a new segment file when the current one reaches KB compressed [default: %default]")
+	g.add_option("", "--query",     type="string", metavar="DIR",
+		help="print samples or rollups stored in DIR as csv (or jsonl with -f jsonl)")
+	g.add_option("", "--resolution", type="choice", default="1m", choices=[l[0] for l in ROLLUP_LEVELS],
+		help="what to query: %s [default: %%default]" % ", ".join(l[0] for l in ROLLUP_LEVELS))
+	g.add_option("", "--query-from", type="string", metavar="TIME",
+		help="skip records before TIME (epoch or 'YYYY-mm-dd HH:MM:SS')")
+	g.add_option("", "--query-to", type="string", metavar="TIME", help="stop at TIME")
+	p.add_option_group(g)
 
 	defdb = ""
 	defusr = "postgres"
@@ -459,6 +2788,7 @@ def main():
 		g = OptionGroup(p, "If you have pa.conf")
 		g.add_option("-c", "--config",  type="string", default=None, help="PA config file [default: %default]")
 		g.add_option("", "--pba",       action="store_true", help = "connect to PBA (POA is default)")
+		g.add_option("", "--poa",       action="store_true", help = "connect to POA, with --pba poll both")
 		p.add_option_group(g)
 		defdb = "plesk"
 		defusr = "plesk"
@@ -475,31 +2805,129 @@ def main():
 	loglevel = logging.DEBUG if opts.verbose else logging.WARNING
 	logging.basicConfig(level=loglevel, format="%(asctime)s - %(module)s - %(levelname)s - %(message)s")
 
+	if opts.delay < MIN_DELAY:
+		p.error("delay must be at least %s sec" % MIN_DELAY)
+	if opts.timeout is None:
+		opts.timeout = 0.9 * opts.delay
+	if opts.min_delay is None:
+		opts.min_delay = max(opts.delay / 4, MIN_DELAY)
+	if opts.max_delay is None:
+		opts.max_delay = 5 * opts.delay
+	if opts.min_delay < MIN_DELAY:
+		p.error("min delay must be at least %s sec" % MIN_DELAY)
+	if opts.max_delay < opts.min_delay:
+		p.error("max delay must not be less than min delay")
+	if not 0 < opts.ash_rate <= 100:
+		p.error("--ash-rate must be within (0, 100]")
+	try:
+		for r in opts.alert:
+			PgStatAlertRule(r)
+	except ValueError, e:
+		p.error(str(e))
+
+	groups = []
+	for name in opts.groups.split(","):
+		name = name.strip()
+		if name == "default":
+			groups += default_groups()
+		elif name == "all":
+			groups += [g.name for g in counter_groups]
+		elif name in [g.name for g in counter_groups]:
+			groups.append(name)
+		else:
+			p.error("unknown counter group '%s', see --help" % name)
+	opts.groups = groups
+	if opts.min_refresh is None:
+		opts.min_refresh = opts.delay
+
+	if opts.query:
+		try:
+			pg_query(opts.query)
+		except (IOError, OSError, ValueError), e:
+			p.error(str(e))
+		return
+
+	if opts.replay:
+		if opts.per_db or opts.adaptive or opts.ash:
+			p.error("--per-db, --adaptive and --ash can not be used with --replay")
+		try:
+			pg_replay(opts.replay)
+		except (IOError, ValueError), e:
+			p.error(str(e))
+		return
+
 	if HAS_PA:
-		if not opts.config and not opts.db_host:
-			p.error("either -c or --db-host option must be provided")
+		if not opts.config and not opts.db_host and not opts.dsn:
+			p.error("either -c, --db-host or --dsn option must be provided")
 	else:
-		if not opts.db_host:
-			p.error("--db-host option must be provided")
+		if not opts.db_host and not opts.dsn:
+			p.error("--db-host or --dsn option must be provided")
 
+	dbs = []
 	if HAS_PA and opts.config:
 		pa_config.init(opts.config)
+		cfg = pa_config.get()
+		if opts.poa or not opts.pba:
+			dbs.append(cfg.poa_db)
 		if opts.pba:
-			b = pa_config.get().pba_db
-		else:
-			b = pa_config.get().poa_db
-
-		opts.db_vendor = b.db_vendor
-		opts.db_host = b.ip
-		opts.db_port = b.db_port
-		opts.db_name = b.db_name
-		opts.db_user = b.db_user
-		opts.db_pass = b.db_pass
+			dbs.append(cfg.pba_db)
+		dbs = [DB(b.ip, b.db_port, b.db_name, b.db_user, b.db_pass) for b in dbs]
+	elif opts.db_host:
+		dbs.append(DB(opts.db_host, opts.db_port, opts.db_name, opts.db_user, opts.db_pass))
+	dbs += [DSN(dsn) for dsn in opts.dsn]
+
+	if opts.per_db and (len(dbs) > 1 or opts.total or opts.listen or opts.record):
+		p.error("--per-db can not be used with several clusters, --listen or --record")
+	if opts.adaptive and (len(dbs) > 1 or opts.total or opts.listen or opts.per_db):
+		p.error("--adaptive can not be used with several clusters, --listen or --per-db")
+	if opts.ash and (len(dbs) > 1 or opts.total or opts.listen or opts.per_db):
+		p.error("--ash can not be used with several clusters, --listen or --per-db")
+	if opts.alert and (opts.per_db or opts.listen):
+		p.error("--alert can not be used with --per-db or --listen")
+	if (opts.summary or opts.summary_json) and (opts.per_db or opts.listen):
+		p.error("--summary can not be used with --per-db or --listen")
+
+	if opts.daemon:
+		if len(dbs) > 1 or opts.total or opts.listen or opts.per_db or opts.adaptive or opts.ash:
+			p.error("--daemon can not be used with several clusters, --listen, --per-db, --adaptive or --ash")
+		try:
+			for level, period, keep in ROLLUP_LEVELS:
+				parse_duration(getattr(opts, keep))
+			pg_daemon(dbs[0], opts.daemon)
+		except (IOError, OSError, ValueError), e:
+			p.error(str(e))
+		return
+
+	if opts.listen:
+		if len(dbs) > 1:
+			p.error("--listen is not supported for several clusters")
+		try:
+			addr, port = opts.listen.rsplit(":", 1)
+			addr = (addr, int(port))
+		except ValueError:
+			p.error("--listen expects ADDR:PORT or :PORT")
+		pg_listen(dbs[0], addr)
+		return
+
+	if len(dbs) > 1 or opts.total:
+		if opts.record:
+			p.error("--record is not supported for several clusters")
+		try:
+			pg_fleet_usage(dbs)
+		except ValueError, e:
+			p.error(str(e))
+		return
 
-	db = DB(opts.db_host, opts.db_port, opts.db_name, opts.db_user, opts.db_pass)
-	print "Connecting to %s ..." % str(db)
+	db = dbs[0]
+	info("Connecting to %s ..." % str(db))
 	con = db.connect()
-	pg_usage()
+	try:
+		if opts.per_db:
+			pg_per_db_usage(con)
+		else:
+			pg_usage(con, db)
+	except (IOError, ValueError), e:
+		p.error(str(e))
 
 if __name__ == "__main__":
 	main()
@@ -15,6 +15,12 @@ except ImportError:
 finally:
 	sys.path = oldpath
 
+HAS_NUMPY = True
+try:
+	import numpy
+except ImportError:
+	HAS_NUMPY = False
+
 import psycopg2
 from optparse import OptionParser, OptionGroup
 import logging
@@ -26,6 +32,18 @@ import mutex
 import StringIO
 import traceback
 import copy
+import math
+import re
+import heapq
+import itertools
+import json
+import csv
+import select
+try:
+	from collections import OrderedDict
+except ImportError:
+	OrderedDict = dict
+from multiprocessing.pool import ThreadPool
 
 
 class DB:
@@ -39,11 +57,19 @@ class DB:
 	def get_name(self):
 		return self.database
 
+	def get_host(self):
+		if str(self.port) == "5432":
+			return self.host
+		return "%s:%s" % (self.host, self.port)
+
 	def __str__(self):
 		return "%s@%s:%s db %s" % (self.user, self.host, self.port, self.database)
 
-	def connect(self):
-		return psycopg2.connect(**(self.__dict__))
+	def connect(self, timeout=None):
+		kwargs = dict(self.__dict__)
+		if timeout:
+			kwargs["connect_timeout"] = int(math.ceil(timeout))
+		return psycopg2.connect(**kwargs)
 
 	@staticmethod
 	def _execute_fetch(con, query, *args):
@@ -78,6 +104,80 @@ class DB:
 			return ret[0]
 
 
+# libpq connection string, either 'key=value ...' or an URI
+class DSN(DB):
+	def __init__(self, dsn):
+		self.dsn = dsn
+		self.params = {}
+		if "://" in dsn:
+			import urlparse
+			u = urlparse.urlparse(dsn)
+			self.params["host"] = u.hostname or "localhost"
+			self.params["port"] = u.port or 5432
+			self.params["dbname"] = u.path.lstrip("/")
+			self.params["user"] = u.username or ""
+		else:
+			for kv in dsn.split():
+				if "=" in kv:
+					k, v = kv.split("=", 1)
+					self.params[k] = v.strip("'")
+
+	def get_name(self):
+		return self.params.get("dbname", "")
+
+	def get_host(self):
+		host = self.params.get("host", "localhost")
+		port = str(self.params.get("port", 5432))
+		return host if port == "5432" else "%s:%s" % (host, port)
+
+	def __str__(self):
+		return "%s@%s db %s" % (self.params.get("user", ""), self.get_host(), self.get_name())
+
+	def connect(self, timeout=None):
+		dsn = self.dsn
+		if timeout and "connect_timeout" not in self.params and "connect_timeout=" not in dsn:
+			param = "connect_timeout=%d" % int(math.ceil(timeout))
+			if "://" in dsn:
+				dsn += ("&" if "?" in dsn else "?") + param
+			else:
+				dsn += " " + param
+		return psycopg2.connect(dsn)
+
+
+# CPU time of the calling thread. time.clock() is of the whole process, the
+# polls of the pool and the sampler included, and Python 2 has no
+# time.thread_time(), so it is clock_gettime() through ctypes.
+def _thread_cpu_clock():
+	if hasattr(time, "thread_time"):
+		return time.thread_time
+	try:
+		import ctypes
+		import ctypes.util
+
+		class timespec(ctypes.Structure):
+			_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+		CLOCK_THREAD_CPUTIME_ID = 3
+		librt = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"), use_errno=True)
+		clock_gettime = librt.clock_gettime
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+		def thread_cpu():
+			t = timespec()
+			if clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(t)):
+				errno = ctypes.get_errno()
+				raise OSError(errno, os.strerror(errno))
+			return t.tv_sec + t.tv_nsec * 1e-9
+
+		thread_cpu()
+		return thread_cpu
+	except Exception:
+		return time.clock
+
+thread_cpu = _thread_cpu_clock()
+
+KEY_UP = 65
+KEY_DOWN = 66
 KEY_LEFT = 68
 KEY_RIGHT = 67
 
@@ -105,61 +205,1157 @@ user_cols_def = [
  ["Reltuples", 10, "int",   True,  "count", "reltuples",     "approximate number of rows in table"]
 ]
 
-user_cols_select_query = """
-SELECT
-	%s
-FROM
-	pg_stat_user_tables U
+# SQL expressions of the columns over pg_stat_user_tables U, the counters
+# of the view itself are not listed
+user_cols_sql = {
+	"tablename":     "CASE WHEN U.schemaname = 'public' THEN U.relname ELSE U.schemaname || '.' || U.relname END",
+	"dbname":        "current_database()",
+	"writes":        "(U.n_tup_ins + U.n_tup_upd + U.n_tup_del)",
+	"n_tup_idx_upd": "(U.n_tup_upd - U.n_tup_hot_upd)",
+	"locks":         "L.locks",
+	"reltuples":     "C.reltuples",
+}
+
+# joins by oid, added only for the aliases the query refers to
+user_cols_joins = [
+	("C", "JOIN pg_class C ON C.oid = U.relid"),
+	("L", "LEFT JOIN (SELECT relation, COUNT(*) locks FROM pg_locks WHERE NOT granted "
+		"GROUP BY relation) L ON L.relation = U.relid"),
+]
 
-	LEFT JOIN (
-		SELECT
-			case WHEN schemaname = 'public'
-			THEN
-				relname
-			ELSE
-				schemaname || '.' || relname
-			END tablename,
-			schemaname AS T_schemaname,
-			relname AS T_relname,
-			current_database() dbname,
-			(n_tup_ins + n_tup_upd + n_tup_del) writes,
-			(n_tup_upd - n_tup_hot_upd) n_tup_idx_upd
-		FROM
-			pg_stat_user_tables
-	) T ON (T_relname = relname AND T_schemaname = U.schemaname)
+index_cols_def = [
+ # title #width  #type    #abs   #metric   #sql_name        #help
+ ["Index",     0, "str",   True,  "",       "indexname",     "index name"],
+ ["Table",    24, "str",   True,  "",       "tablename",     "table of the index"],
+ ["DB",        5, "str",   True,  "",       "dbname",        "database"],
+ ["Scan",      8, "int",   False, "scan/s", "idx_scan",      "number of index scans per second"],
+ ["TupRead",   9, "int",   False, "row/s",  "idx_tup_read",  "number of index entries returned by scans per second"],
+ ["TupFetch",  9, "int",   False, "row/s",  "idx_tup_fetch", "number of live table rows fetched by simple index scans per second"],
+ ["Scans",    10, "int",   True,  "count",  "idx_scans",     "number of index scans since the statistics reset, 0 for the unused ones"],
+ ["Size",      9, "float", True,  "MB",     "size",          "approximate size of the index"]
+]
+
+index_cols_sql = {
+	"indexname":     "CASE WHEN U.schemaname = 'public' THEN U.indexrelname ELSE U.schemaname || '.' || U.indexrelname END",
+	"tablename":     "CASE WHEN U.schemaname = 'public' THEN U.relname ELSE U.schemaname || '.' || U.relname END",
+	"dbname":        "current_database()",
+	"idx_scans":     "U.idx_scan",
+	"size":          "C.relpages::bigint * current_setting('block_size')::int / 1048576.0",
+}
+
+index_cols_joins = [
+	("C", "JOIN pg_class C ON C.oid = U.indexrelid"),
+]
+
+io_cols_def = [
+ # title #width  #type    #abs   #metric   #sql_name        #help
+ ["Table",     0, "str",   True,  "",       "tablename",     "table name"],
+ ["DB",        5, "str",   True,  "",       "dbname",        "database"],
+ ["HeapRead",  9, "int",   False, "blk/s",  "heap_blks_read", "number of heap blocks read per second, i.e. not found in shared buffers"],
+ ["HeapHit",   9, "int",   False, "blk/s",  "heap_blks_hit", "number of heap blocks found in shared buffers per second"],
+ ["Heap%",     6, "float", True,  "hit",    "heap_hit",      "percent of heap blocks found in shared buffers over the interval"],
+ ["IdxRead",   9, "int",   False, "blk/s",  "idx_blks_read", "number of blocks of all the indexes of the table read per second"],
+ ["IdxHit",    9, "int",   False, "blk/s",  "idx_blks_hit",  "number of blocks of all the indexes of the table found in shared buffers per second"],
+ ["Idx%",      6, "float", True,  "hit",    "idx_hit",       "percent of index blocks found in shared buffers over the interval"],
+ ["ToastRead", 9, "int",   False, "blk/s",  "toast_read",    "number of blocks of the TOAST table and its index read per second"],
+ ["ToastHit",  9, "int",   False, "blk/s",  "toast_hit",     "number of blocks of the TOAST table and its index found in shared buffers per second"]
+]
+
+io_cols_sql = {
+	"tablename":     "CASE WHEN U.schemaname = 'public' THEN U.relname ELSE U.schemaname || '.' || U.relname END",
+	"dbname":        "current_database()",
+	"heap_hit":      "0",
+	"idx_hit":       "0",
+	"toast_read":    "(COALESCE(U.toast_blks_read, 0) + COALESCE(U.tidx_blks_read, 0))",
+	"toast_hit":     "(COALESCE(U.toast_blks_hit, 0) + COALESCE(U.tidx_blks_hit, 0))",
+}
+
+io_cols_joins = [
+	("C", "JOIN pg_class C ON C.oid = U.relid"),
+]
+
+statement_cols_def = [
+ # title #width  #type    #abs   #metric   #sql_name        #help
+ ["Query",     0, "str",   True,  "",       "query",         "statement text as normalized by pg_stat_statements"],
+ ["DB",        5, "str",   True,  "",       "dbname",        "database"],
+ ["Time",      9, "float", False, "ms/s",   "total_time",    "execution time of the statement per second"],
+ ["Calls",     8, "int",   False, "call/s", "calls",         "number of executions per second"],
+ ["Mean",      8, "float", True,  "ms",     "mean_time",     "mean execution time of the calls over the interval"],
+ ["Rows",      9, "int",   False, "row/s",  "rows",          "number of rows retrieved or affected per second"],
+ ["BlkHit",    9, "int",   False, "blk/s",  "shared_blks_hit", "number of shared blocks found in shared buffers per second"],
+ ["BlkRead",   9, "int",   False, "blk/s",  "shared_blks_read", "number of shared blocks read per second"],
+ ["TmpWrite",  9, "int",   False, "blk/s",  "temp_blks_written", "number of temporary blocks written per second"]
+]
+
+statement_cols_sql = {
+	"query":         "''",
+	"dbname":        "current_database()",
+	"mean_time":     "0",
+}
+
+session_cols_def = [
+ # title #width  #type    #abs   #metric   #sql_name        #help
+ ["Query",     0, "str",   True,  "",       "query",         "query text with the literals replaced by ?, the same ones make one row"],
+ ["DB",        5, "str",   True,  "",       "dbname",        "database"],
+ ["State",    20, "str",   True,  "",       "state",         "state of the sessions, the idle ones are not shown"],
+ ["Wait",     20, "str",   True,  "",       "wait",          "event the most of the sessions wait for, type:name"],
+ ["Count",     6, "int",   True,  "count",  "sessions",      "number of sessions running the query in this state"],
+ ["Pid",       7, "int",   True,  "",       "pid",           "process of the session running the query the longest"],
+ ["XactAge",   9, "float", True,  "s",      "xact_age",      "age of the oldest transaction"],
+ ["QueryAge",  9, "float", True,  "s",      "query_age",     "age of the oldest query, or the time idle in transaction"]
+]
+
+lock_cols_def = [
+ # title #width  #type    #abs   #metric   #sql_name        #help
+ ["Session",   0, "str",   True,  "",       "session",       "pid and query of the session, under the session blocking it"],
+ ["DB",        5, "str",   True,  "",       "dbname",        "database"],
+ ["Mode",     20, "str",   True,  "",       "mode",          "mode of the lock the session waits for"],
+ ["Relation", 24, "str",   True,  "",       "relation",      "relation of the lock, or its type for the others, e.g. transactionid"],
+ ["Wait",      9, "float", True,  "s",      "wait",          "time waiting for the lock"],
+ ["XactAge",   9, "float", True,  "s",      "xact_age",      "age of the transaction"],
+ ["Blocked",   8, "int",   True,  "count",  "blocked",       "number of sessions waiting for this one, directly or not"],
+ ["State",    20, "str",   True,  "",       "state",         "state of the session"]
+]
+
+def sql_array(values, type):
+	return "'{%s}'::%s[]" % (",".join([repr(v) if isinstance(v, float) else str(v) for v in values]), type)
+
+# comments, literals, identifiers and numbers of a query; identifiers are
+# matched as a whole so the digits in them are not taken for numbers
+FINGERPRINT_RE = re.compile(r"""
+	(?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+	|(?P<literal>[eE]'(?:[^'\\]|\\.|'')*(?:'|\Z)|[bBxXnN]?'(?:[^']|'')*(?:'|\Z)
+		|\$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?(?:\$(?P=tag)\$|\Z))
+	|(?P<ident>"(?:[^"]|"")*"?|[A-Za-z_][\w$]*)
+	|(?P<number>\$\d+|(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+""", re.S | re.X)
+
+# lists of 2 and more values, as in IN (1, 2, 3)
+FINGERPRINT_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+def _fingerprint_token(m):
+	if m.group("comment") is not None:
+		return " "
+	if m.group("ident") is not None:
+		return m.group("ident")
+	return "?"
+
+# The query with the literals, numbers and parameters replaced by ? and the
+# lists of them by (...), without comments and with single spaces: the same
+# query with other values gives the same text. The texts cut by
+# track_activity_query_size end in the middle of anything, so the
+# unterminated literals and comments run to the end.
+def fingerprint(query):
+	query = FINGERPRINT_RE.sub(_fingerprint_token, query or "")
+	return " ".join(FINGERPRINT_LIST_RE.sub("(...)", query).split())
+
+# The fingerprints by query text, the ones used last are kept: the same texts
+# come with every poll and only the new ones are parsed. It is shared by the
+# polls of all the databases.
+class PgTopFingerprints:
+	def __init__(self, size):
+		self.size = size
+		self.memo = OrderedDict()
+		self.mutex = threading.Lock()
+
+	def get(self, queries):
+		memo = self.memo
+		out = []
+		self.mutex.acquire()
+		try:
+			for query in queries:
+				fp = memo.pop(query, None)
+				if fp is None:
+					fp = fingerprint(query)
+					if len(memo) >= self.size:
+						del memo[next(iter(memo))]
+				memo[query] = fp
+				out.append(fp)
+		finally:
+			self.mutex.release()
+		return out
+
+# A screen of pg-top: its columns, the statistics view they come from and
+# the oid keying its rows. Subclasses only fill the attributes in.
+class PgTopView:
+	name = None		# the name for --view
+	key = None		# the key switching to the view
+	cols_def = []
+	source = None		# the statistics view, aliased U
+	relid = None		# the key of the rows
+	key_type = "oid"
+	schema = "U.schemaname"	# filtered by --schema
+	sql = {}		# expressions of the columns, U.<sql_name> if not here
+	joins = []		# (alias, join), added only when the alias is used
+	sort = None		# the column sorted at first
+	tiebreak = None		# orders the rows of equal sort values on the server
+	ties = []		# and the columns doing it on the screen
+	ascending = []		# columns sorted lowest first, the others highest
+	parent = None		# filtered by the table selected in the tables view
+	derived = {}		# columns computed from the rates of two others,
+				# by column: (operation of PgTopListOps, a, b)
+	counters = True		# the rows are counters, not the state at hand
+	maxed = []		# columns whose Total over the databases is the max
+
+	def __init__(self):
+		self.meta = []
+		self.hash = {}
+		self.sorted = 0
+		self.scroll = 0
+		self.cursor = 0 # the selected row, the Total one is 0
+		self.filter = None # (db, relid, name) of the selected table
+		self.formats = None
+
+	def init_cols(self, con, sort=None):
+		sort = sort or self.sort
+		self.meta = []
+		self.hash = {}
+		self.formats = None
+
+		for col in self.cols_def:
+
+			# hide dB if there is only one DB
+			if col[USER_COL_NAME].lower() == "db":
+				if len(con) == 1:
+					continue
+				if con:
+					col[USER_COL_WIDTH] = max(5, min(20, max([len(c.name) for c in con])))
+
+			self.meta.append(col)
+
+		for n in xrange(0, len(self.meta)):
+			self.hash[self.meta[n][USER_COL_NAME]] = n
+			if self.meta[n][USER_COL_NAME] == sort:
+				self.sorted = n
+
+	def describe(self):
+		if self.filter:
+			return "%s of %s" % (self.name, self.filter[2])
+		return self.name
+
+	# the statistics view, the server_version_num of the database given
+	def from_clause(self, version):
+		return self.source + " U"
+
+	# the counters are never NULL, so they go to arrays as is
+	def expr(self, col):
+		expr = self.sql.get(col[USER_COL_SQL_NAME], "U." + col[USER_COL_SQL_NAME])
+		if col[USER_COL_TYPE] == "str":
+			return expr
+		return "COALESCE(%s, 0)" % expr
+
+	# the rows of a poll are the top ones, completes them if needed
+	def finish(self, conn, data, rows):
+		return rows
+
+	# True if counters went away or were reset since the last poll where
+	# it is not told by a counter going down, that interval is skipped
+	def was_reset(self, conn, data):
+		return False
+
+	# Builds the query of one poll: the key, the columns and the total of
+	# every numeric one over all the rows, so the Total row stays right when
+	# only the top rows are fetched.
+	#
+	# With sort the server returns only the limit rows first by that column.
+	# For the rates, prev is (keys, values, times) of the last seen counters
+	# of the rows which may have changed, the ones missing are taken as not
+	# changed since base, i.e. the last full scan.
+	def query(self, version, schema=None, sort=None, limit=None, prev=None, now=None, base=None):
+		cols = self.meta
+		select = ["%s AS relid" % self.relid]
+		select += ["%s AS %s" % (self.expr(c), c[USER_COL_SQL_NAME]) for c in cols]
+		select += ["SUM(%s) OVER () AS sum_%s" % (self.expr(c), c[USER_COL_SQL_NAME])
+			for c in cols if c[USER_COL_TYPE] != "str"]
+
+		order = None
+		if sort is not None:
+			if sort[USER_COL_TYPE] == "str" or sort[USER_COL_ABS]:
+				order = sort[USER_COL_SQL_NAME]
+			else:
+				# a counter below the last seen was reset, it counts from 0
+				last = "COALESCE(P.v, %s)" % self.expr(sort)
+				order = "(%s - CASE WHEN %s >= %s THEN %s ELSE 0 END) / GREATEST(%r - COALESCE(P.t, %r), 0.001)" % \
+					(self.expr(sort), self.expr(sort), last, last, now, base)
+			order = "%s DESC, %s DESC" % (order, self.tiebreak)
+
+		query = "SELECT\n\t%s\nFROM\n\t%s" % (",\n\t".join(select), self.from_clause(version))
+		for alias, join in self.joins:
+			if re.search(r"\b%s\." % alias, " ".join(select + [order or ""])):
+				query += "\n\t" + join
+		if order and prev is not None:
+			query += "\n\tLEFT JOIN (SELECT unnest(%s) relid, unnest(%s) v, unnest(%s) t) P ON P.relid = %s" % \
+				(sql_array(prev[0], self.key_type), sql_array(prev[1], "float8"), sql_array(prev[2], "float8"),
+				self.relid)
+		where = []
+		if schema and self.schema:
+			where.append("%s = '%s'" % (self.schema, schema))
+		if self.parent and self.filter:
+			where.append("%s = %d" % (self.parent, self.filter[1]))
+		if where:
+			query += "\nWHERE " + " AND ".join(where)
+		if order:
+			query += "\nORDER BY %s\nLIMIT %d" % (order, limit)
+		return query
+
+	# The values of the Total row from its counters and the ones seen at
+	# prev, (time, counters), or at base the first time. The total goes down
+	# when rows go away, which is not a reset, so nothing is counted then.
+	def rates(self, new, prev, t, base):
+		out = []
+		for n in xrange(0, len(new)):
+			meta = self.meta[n]
+			if meta[USER_COL_TYPE] == "str":
+				out.append(str(new[n]))
+				continue
+			if meta[USER_COL_ABS]:
+				out.append(new[n])
+				continue
+
+			val = max(0, (new[n] or 0) - (prev[1][n] if prev and prev[1][n] else 0))
+			dt = t - (prev[0] if prev else base)
+			if meta[USER_COL_METRIC].endswith("/s") and dt:
+				val = int(val) / dt
+			out.append(val)
+		return out
+
+	# Makes the rows and the Total row of a view without counters out of its
+	# poll, which always fetches all its rows
+	def collect(self, conn, data, rows):
+		return [], None
+
+	# adds the Total row of another database to total
+	def add_total(self, total, other):
+		for n in xrange(0, len(total)):
+			if self.meta[n][USER_COL_NAME] in self.maxed:
+				total[n] = max(total[n], other[n])
+			elif self.meta[n][USER_COL_TYPE] != "str":
+				total[n] += other[n]
+
+	# the curses attribute of a row which stands out
+	def attr(self, row):
+		return 0
+
+	# sets the derived columns of out, the columns as vectors of ops
+	def derive(self, out, ops):
+		for col, (op, a, b) in self.derived.items():
+			if col in self.hash:
+				out[self.hash[col]] = getattr(ops, op)(out[self.hash[a]], out[self.hash[b]])
+
+	# rounds the rates of the int columns of out, only once the derived
+	# columns are set from the exact ones
+	def round(self, out, ops):
+		for n in xrange(0, len(self.meta)):
+			if self.meta[n][USER_COL_TYPE] == "int" and not self.meta[n][USER_COL_ABS]:
+				out[n] = ops.round(out[n])
+
+	def is_derived(self, col):
+		return col[USER_COL_NAME] in self.derived
+
+	# the columns ordering the rows on the screen
+	def order(self):
+		return [self.sorted] + [self.hash[c] for c in self.ties]
+
+	# the columns of order() sorted lowest first
+	def lowest(self):
+		return [self.hash[c] for c in self.ascending if c in self.hash]
+
+	# the rows of all the databases in the order of the screen
+	def sort_rows(self, rows):
+		order = self.order()
+		lowest = self.lowest()
+		return sorted(rows, key=lambda x: tuple([-x[n] if n in lowest else x[n] for n in order]), reverse=True)
+
+	# the formats of the header and the data lines, built again only when
+	# the width of the terminal changes
+	def get_formats(self, max_x):
+		if self.formats and self.formats[0] == max_x:
+			return self.formats[1:]
+
+		s = sum([c[1] + 1 for c in self.meta])
+		s -= self.meta[0][USER_COL_WIDTH]
+		self.meta[0][USER_COL_WIDTH] = max_x - s
 
-	LEFT JOIN (
+		fmt = []
+		for c in self.meta:
+			if c[USER_COL_TYPE] == "int":
+				fmt.append("%%%dd" % c[1])
+			elif c[USER_COL_TYPE] == "float":
+				fmt.append("%%%d.1f" % c[1])
+			else:
+				fmt.append("%%%ds" % c[1])
+		fmt_data = " ".join(fmt)
+		fmt_header = " ".join(["%%%ds" % c[USER_COL_WIDTH] for c in self.meta])
+		self.formats = (max_x, fmt_data, fmt_header)
+		return self.formats[1:]
+
+	# the rows carry their key after the columns
+	def format_row(self, row, fmt_data):
+		out = list(row[:len(self.meta)])
+		for n in xrange(0, len(out)):
+			w = self.meta[n][USER_COL_WIDTH]
+			if self.meta[n][USER_COL_TYPE] == "str" and len(out[n]) > w:
+				out[n] = out[n][0:w-3] + "..."
+		return fmt_data % tuple(out)
+
+class PgTopTablesView(PgTopView):
+	name = "tables"
+	key = "t"
+	cols_def = user_cols_def
+	source = "pg_stat_user_tables"
+	relid = "U.relid"
+	sql = user_cols_sql
+	joins = user_cols_joins
+	sort = "Write"
+	tiebreak = "C.reltuples"
+	ties = ["Write", "Reltuples"]
+
+class PgTopIndexesView(PgTopView):
+	name = "indexes"
+	key = "i"
+	cols_def = index_cols_def
+	source = "pg_stat_user_indexes"
+	relid = "U.indexrelid"
+	sql = index_cols_sql
+	joins = index_cols_joins
+	sort = "Scan"
+	tiebreak = "C.relpages"
+	ties = ["Scan", "Size"]
+	parent = "U.relid"
+
+class PgTopIoView(PgTopView):
+	name = "io"
+	key = "o"
+	cols_def = io_cols_def
+	source = "pg_statio_user_tables"
+	relid = "U.relid"
+	sql = io_cols_sql
+	joins = io_cols_joins
+	sort = "HeapRead"
+	tiebreak = "C.relpages"
+	ties = ["HeapRead", "IdxRead"]
+	# the tables missing the cache the most come first
+	ascending = ["Heap%", "Idx%"]
+	derived = {"Heap%": ("ratio", "HeapHit", "HeapRead"), "Idx%": ("ratio", "IdxHit", "IdxRead")}
+
+	# the same ratio goes by the hits, so of the 100 ones those without I/O
+	# go after the ones all found in shared buffers
+	def order(self):
+		col = self.meta[self.sorted][USER_COL_NAME]
+		if col in self.derived:
+			return [self.sorted, self.hash[self.derived[col][1]]] + [self.hash[c] for c in self.ties]
+		return PgTopView.order(self)
+
+# The statements of the database in pg_stat_statements, summed by queryid over
+# the users. The texts are fetched only for the rows shown and only once.
+class PgTopStatementsView(PgTopView):
+	name = "statements"
+	key = "s"
+	cols_def = statement_cols_def
+	relid = "U.queryid"
+	key_type = "int8"
+	schema = None
+	sql = statement_cols_sql
+	sort = "Time"
+	tiebreak = "U.calls"
+	ties = ["Time", "Calls"]
+	derived = {"Mean": ("quotient", "Time", "Calls")}
+
+	# texts kept at most, besides the ones of the statements seen
+	TEXTS_SLACK = 1000
+
+	# SUM() of bigint is numeric, which comes as Decimal and does not mix
+	# with the float times of the rates. Without the texts the server does
+	# not read the file of them, only finish() asks for those.
+	def from_clause(self, version):
+		return """(
 		SELECT
-			relname AS L_relname,
-			nspname AS L_schemaname,
-			reltuples,
-			case WHEN L_locks > 0
-			THEN
-				L_locks
-			ELSE
-				0
-			END locks
+			queryid,
+			SUM(calls)::float8 calls,
+			SUM(%s) total_time,
+			SUM(rows)::float8 AS rows,
+			SUM(shared_blks_hit)::float8 shared_blks_hit,
+			SUM(shared_blks_read)::float8 shared_blks_read,
+			SUM(temp_blks_written)::float8 temp_blks_written
 		FROM
-			pg_class C
+			pg_stat_statements(false)
+		WHERE
+			dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+			AND queryid IS NOT NULL
+		GROUP BY
+			queryid
+	) U""" % ("total_exec_time" if version >= 130000 else "total_time")
+
+	def finish(self, conn, data, rows):
+		texts = data.cache
+		missing = [r[-1] for r in rows if r[-1] not in texts]
+		if missing:
+			for queryid, query in DB.execute_fetchall(conn.con, "SELECT DISTINCT ON (queryid) queryid, query "
+					"FROM pg_stat_statements WHERE queryid = ANY(%s)" % sql_array(missing, "int8")):
+				texts[queryid] = " ".join((query or "").split())
+			conn.con.commit()
+			# the ones gone from pg_stat_statements since
+			if len(texts) > len(data.columns.pos) + self.TEXTS_SLACK:
+				for queryid in texts.keys():
+					if queryid not in data.columns.pos:
+						del texts[queryid]
+		n = self.hash["Query"]
+		return [r[:n] + (texts.get(r[-1], "<gone>"),) + r[n + 1:] for r in rows]
+
+	# A row sums the entries of a queryid over the users, so when one of
+	# them is deallocated the sum only goes down by it, which is taken for
+	# a reset and counts the rest as the interval. Since 14 the deallocations
+	# and resets are counted.
+	def was_reset(self, conn, data):
+		if conn.version < 140000:
+			return False
+		epoch = DB.execute_fetchone(conn.con, "SELECT dealloc, stats_reset FROM pg_stat_statements_info")
+		reset = data.epoch is not None and epoch != data.epoch
+		data.epoch = epoch
+		return reset
+
+# The columns of pg_stat_activity A by server version: before 9.2 the state
+# is told by the query text, before 9.6 a session only waits for a lock.
+# since is when the query started, or the session went idle.
+def activity_cols(version):
+	if version >= 90200:
+		cols = {
+			"pid":   "A.pid",
+			"query": "A.query",
+			"state": "A.state",
+			"since": "CASE WHEN A.state = 'active' THEN A.query_start ELSE A.state_change END",
+		}
+	else:
+		cols = {
+			"pid":   "A.procpid",
+			"query": "A.current_query",
+			"state": "CASE A.current_query WHEN '<IDLE>' THEN 'idle' "
+				"WHEN '<IDLE> in transaction' THEN 'idle in transaction' ELSE 'active' END",
+			"since": "A.query_start",
+		}
+	if version >= 90600:
+		cols["wait"] = "COALESCE(A.wait_event_type || ':' || A.wait_event, '')"
+	else:
+		cols["wait"] = "CASE WHEN A.waiting THEN 'Lock' ELSE '' END"
+	return cols
+
+# The sessions of the database in pg_stat_activity but the idle ones, with
+# the same query in the same state on one row. It is the state at hand, so
+# all the sessions are fetched on every poll and grouped here.
+class PgTopSessionsView(PgTopView):
+	name = "sessions"
+	key = "a"
+	cols_def = session_cols_def
+	relid = "pid"
+	schema = None
+	sort = "QueryAge"
+	ties = ["QueryAge", "Count"]
+	counters = False
+	maxed = ["XactAge", "QueryAge"]
+
+	# query texts whose fingerprints are kept
+	FINGERPRINTS = 10000
+	# queries running longer are highlighted, as are the sessions idle in
+	# transaction
+	LONG_QUERY = 10
+
+	def __init__(self):
+		PgTopView.__init__(self)
+		self.fingerprints = PgTopFingerprints(self.FINGERPRINTS)
+
+	# (pid, state, wait, xact_age, query_age, query) of every session
+	def query(self, version, schema=None, sort=None, limit=None, prev=None, now=None, base=None):
+		return """SELECT
+	%(pid)s,
+	COALESCE(%(state)s, ''),
+	%(wait)s,
+	COALESCE(EXTRACT(EPOCH FROM now() - A.xact_start), 0),
+	COALESCE(EXTRACT(EPOCH FROM now() - %(since)s), 0),
+	%(query)s
+FROM
+	pg_stat_activity A
+WHERE
+	A.datname = current_database()
+	AND %(pid)s <> pg_backend_pid()
+	AND %(state)s <> 'idle'""" % activity_cols(version)
+
+	def collect(self, conn, data, rows):
+		groups = {}
+		for row, fp in itertools.izip(rows, self.fingerprints.get([r[5] for r in rows])):
+			pid, state, wait, xact_age, query_age = row[:5]
+			key = (state, fp)
+			g = groups.get(key)
+			if g is None:
+				g = groups[key] = {"query": fp, "dbname": conn.name, "state": state, "waits": {},
+					"sessions": 0, "pid": pid, "xact_age": 0.0, "query_age": -1.0}
+			g["sessions"] += 1
+			if wait:
+				g["waits"][wait] = g["waits"].get(wait, 0) + 1
+			g["xact_age"] = max(g["xact_age"], float(xact_age))
+			if float(query_age) > g["query_age"]:
+				g["query_age"] = float(query_age)
+				g["pid"] = pid
+
+		out = []
+		for key, g in groups.iteritems():
+			waits = g["waits"]
+			g["wait"] = max(waits, key=waits.get) if waits else ""
+			out.append(tuple([g[c[USER_COL_SQL_NAME]] for c in self.meta]) + (key,))
+
+		total = []
+		for c in self.meta:
+			if c[USER_COL_TYPE] == "str":
+				total.append("")
+			elif c[USER_COL_SQL_NAME] == "sessions":
+				total.append(len(rows))
+			elif c[USER_COL_TYPE] == "float":
+				total.append(max([r[self.hash[c[USER_COL_NAME]]] for r in out] or [0.0]))
+			else:
+				total.append(0)
+		return out, total
+
+	def attr(self, row):
+		if row[-1] is None:
+			return 0
+		state = row[self.hash["State"]]
+		if state.startswith("idle in transaction") or \
+				(state == "active" and row[self.hash["QueryAge"]] >= self.LONG_QUERY):
+			return curses.A_BOLD
+		return 0
+
+# The sessions waiting for locks of the database under the ones blocking
+# them, the head blockers first. A session blocked by several ones is under
+# the first one. All of it comes with a single query, the tree is built here.
+class PgTopLocksView(PgTopView):
+	name = "locks"
+	key = "l"
+	cols_def = lock_cols_def
+	relid = "pid"
+	schema = None
+	sort = "Blocked"
+	ties = ["Blocked", "Wait"]
+	counters = False
+	maxed = ["Wait", "XactAge"]
+
+	# (pid, blockers) of the sessions waiting for a lock. Before 9.6 there
+	# is no pg_blocking_pids(), so the blockers are the ones holding a lock
+	# on the same object, whatever its mode.
+	def blockers(self, version):
+		if version >= 90600:
+			return """SELECT * FROM (
+		SELECT A.pid, pg_blocking_pids(A.pid) blockers
+		FROM pg_stat_activity A
+		WHERE A.datname = current_database() AND A.wait_event_type = 'Lock'
+	) W WHERE blockers <> '{}'"""
+		return """SELECT W.pid, array_agg(DISTINCT H.pid) blockers
+	FROM pg_locks W
+		JOIN pg_locks H ON H.granted AND H.pid <> W.pid
+			AND H.locktype = W.locktype
+			AND H.database IS NOT DISTINCT FROM W.database
+			AND H.relation IS NOT DISTINCT FROM W.relation
+			AND H.page IS NOT DISTINCT FROM W.page
+			AND H.tuple IS NOT DISTINCT FROM W.tuple
+			AND H.virtualxid IS NOT DISTINCT FROM W.virtualxid
+			AND H.transactionid IS NOT DISTINCT FROM W.transactionid
+			AND H.classid IS NOT DISTINCT FROM W.classid
+			AND H.objid IS NOT DISTINCT FROM W.objid
+			AND H.objsubid IS NOT DISTINCT FROM W.objsubid
+	WHERE NOT W.granted
+		AND W.pid IN (SELECT %s FROM pg_stat_activity A WHERE A.datname = current_database())
+	GROUP BY W.pid""" % activity_cols(version)["pid"]
+
+	# (pid, blockers, mode, relation, wait, xact_age, state, query) of the
+	# sessions waiting and of the ones blocking them
+	def query(self, version, schema=None, sort=None, limit=None, prev=None, now=None, base=None):
+		cols = activity_cols(version)
+		cols["blockers"] = self.blockers(version)
+		if version >= 140000:
+			cols["waiting"] = "L.waitstart"
+		else:
+			cols["waiting"] = "CASE WHEN L.pid IS NOT NULL THEN %(since)s END" % cols
+		return """WITH B AS (
+	%(blockers)s
+)
+SELECT
+	%(pid)s,
+	B.blockers,
+	COALESCE(L.mode, ''),
+	COALESCE(L.relation::regclass::text, L.locktype, ''),
+	COALESCE(EXTRACT(EPOCH FROM now() - %(waiting)s), 0),
+	COALESCE(EXTRACT(EPOCH FROM now() - A.xact_start), 0),
+	COALESCE(%(state)s, ''),
+	%(query)s
+FROM
+	pg_stat_activity A
+	LEFT JOIN B ON B.pid = %(pid)s
+	LEFT JOIN pg_locks L ON L.pid = %(pid)s AND NOT L.granted
+WHERE
+	B.pid IS NOT NULL
+	OR %(pid)s IN (SELECT unnest(blockers) FROM B)""" % cols
+
+	def collect(self, conn, data, rows):
+		nodes = {}
+		for row in rows:
+			nodes[row[0]] = row
+		parent = {}
+		children = {}
+		for pid, blockers in [r[:2] for r in rows]:
+			up = [b for b in blockers or [] if b in nodes]
+			if up:
+				parent[pid] = up[0]
+				children.setdefault(up[0], []).append(pid)
+
+		# walks the trees from the head blockers, a session of a cycle not
+		# broken yet by the deadlock detector becomes a head too
+		depth = {}
+		walk = []
+		heads = [pid for pid in nodes if pid not in parent]
+		for pid in itertools.chain(heads, nodes):
+			if pid in depth:
+				continue
+			parent.pop(pid, None)
+			depth[pid] = 0
+			stack = [pid]
+			while stack:
+				p = stack.pop()
+				walk.append(p)
+				for c in children.get(p, []):
+					if c not in depth:
+						depth[c] = depth[p] + 1
+						stack.append(c)
+
+		# the sessions under each one, leaves first
+		blocked = dict([(pid, 0) for pid in nodes])
+		for pid in reversed(walk):
+			if pid in parent:
+				blocked[parent[pid]] += blocked[pid] + 1
+
+		out = []
+		for pid in walk:
+			_, _, mode, relation, wait, xact_age, state, query = nodes[pid]
+			d = depth[pid]
+			values = {
+				"session":  "%s%d %s" % ("  " * (d - 1) + "`- " if d else "", pid, " ".join((query or "").split())),
+				"dbname":   conn.name,
+				"mode":     mode[:-4] if mode.endswith("Lock") else mode,
+				"relation": relation,
+				"wait":     float(wait),
+				"xact_age": float(xact_age),
+				"blocked":  blocked[pid],
+				"state":    state,
+			}
+			out.append(tuple([values[c[USER_COL_SQL_NAME]] for c in self.meta]) + ((conn.name, pid, parent.get(pid)),))
+
+		total = []
+		for c in self.meta:
+			if c[USER_COL_TYPE] == "str":
+				total.append("")
+			elif c[USER_COL_SQL_NAME] == "blocked":
+				total.append(len(parent))
+			else:
+				total.append(max([r[self.hash[c[USER_COL_NAME]]] for r in out] or [0.0]))
+		return out, total
+
+	# the heads ordered by the sorted column, each followed by the sessions
+	# it blocks ordered the same way
+	def sort_rows(self, rows):
+		order = self.order()
+		key = lambda x: tuple([x[n] for n in order])
+		children = {}
+		for row in rows:
+			db, pid, up = row[-1]
+			children.setdefault((db, up), []).append(row)
+		out = []
+		stack = sorted([r for r in rows if r[-1][2] is None], key=key)
+		while stack:
+			row = stack.pop()
+			out.append(row)
+			stack += sorted(children.get(row[-1][:2], []), key=key)
+		return out
+
+	# the tree reads from the left
+	def get_formats(self, max_x):
+		fmt_data, fmt_header = PgTopView.get_formats(self, max_x)
+		return fmt_data.replace("%", "%-", 1), fmt_header.replace("%", "%-", 1)
+
+	def attr(self, row):
+		if row[-1] is not None and row[-1][2] is None and row[self.hash["Blocked"]]:
+			return curses.A_BOLD
+		return 0
+
+pg_top_views = [PgTopTablesView, PgTopIndexesView, PgTopIoView, PgTopStatementsView, PgTopSessionsView,
+	PgTopLocksView]
+
+# Result of one sampling round of a view, never changed once published: the
+# rows are tuples in the order of its columns with the rates already
+# computed, so the screen can be re-sorted and redrawn without touching the
+# database. status lists the databases which are not fine, with the reason,
+# total is the Total row over all the rows, not only the ones fetched.
+class PgTopSnapshot:
+	def __init__(self, view, ctime, rows, status=(), total=None, cpu=0):
+		self.view = view
+		self.ctime = ctime
+		self.rows = tuple(rows)
+		self.status = tuple(status)
+		self.total = total
+		self.cpu = cpu # spent on the rates
+
+# Array operations of PgTopColumns, on lists
+class PgTopListOps:
+	name = "python"
+
+	@staticmethod
+	def array(values):
+		return list(values)
+
+	@staticmethod
+	def index(idx):
+		return idx
+
+	@staticmethod
+	def take(v, idx, default):
+		return [v[i] if i >= 0 else default for i in idx]
+
+	@staticmethod
+	def put(v, idx, values):
+		for i, x in itertools.izip(idx, values):
+			v[i] = x
+
+	@staticmethod
+	def append(v, values):
+		return v + list(values)
+
+	# a counter below the last seen was reset, it counts from 0
+	@staticmethod
+	def rates(new, old, dt):
+		if dt is None:
+			return [a - b if a >= b else a for a, b in itertools.izip(new, old)]
+		return [(a - b if a >= b else a) / d for a, b, d in itertools.izip(new, old, dt)]
+
+	@staticmethod
+	def round(v):
+		return [round(x) for x in v]
+
+	@staticmethod
+	def elapsed(t, times):
+		return [max(t - x, 0.001) for x in times]
+
+	@staticmethod
+	def nonzero(v):
+		return [i for i in xrange(0, len(v)) if v[i]]
+
+	@staticmethod
+	def after(times, t):
+		return [i for i in xrange(0, len(times)) if times[i] > t]
+
+	@staticmethod
+	def top(keys, n):
+		return heapq.nlargest(n, xrange(0, len(keys[0])), key=lambda i: tuple([k[i] for k in keys]))
+
+	# nothing read or hit is 100, nothing missed the cache, so sorted lowest
+	# first the idle rows go last
+	@staticmethod
+	def ratio(hit, read):
+		return [100.0 * h / (h + r) if h + r else 100.0 for h, r in itertools.izip(hit, read)]
+
+	@staticmethod
+	def negative(v):
+		return [-x for x in v]
+
+	@staticmethod
+	def quotient(a, b):
+		return [float(x) / y if y else 0.0 for x, y in itertools.izip(a, b)]
+
+	@staticmethod
+	def select(v, sel):
+		return [v[i] for i in sel]
+
+	@staticmethod
+	def tolist(v):
+		return v
+
+# Array operations of PgTopColumns, on numpy arrays
+class PgTopNumpyOps:
+	name = "numpy"
+
+	@staticmethod
+	def array(values):
+		return numpy.fromiter(values, dtype=float, count=len(values))
 
-			LEFT JOIN (
-				SELECT
-					relation,
-					COUNT(*) L_locks
-				FROM
-					pg_locks
-				WHERE
-					NOT granted
-				GROUP BY
-					relation
-			) L ON L.relation = C.oid
+	@staticmethod
+	def index(idx):
+		return numpy.fromiter(idx, dtype=int, count=len(idx))
+
+	@staticmethod
+	def take(v, idx, default):
+		return numpy.where(idx >= 0, v[idx] if len(v) else default, default)
+
+	@staticmethod
+	def put(v, idx, values):
+		v[idx] = values
+
+	@staticmethod
+	def append(v, values):
+		return numpy.concatenate((v, values))
 
-			LEFT JOIN pg_namespace n ON n.oid = C.relnamespace
+	@staticmethod
+	def rates(new, old, dt):
+		ret = numpy.where(new >= old, new - old, new)
+		if dt is not None:
+			ret /= dt
+		return ret
 
-	) L ON (L_relname = relname AND L_schemaname = U.schemaname)
-"""
+	@staticmethod
+	def round(v):
+		return numpy.round(v)
 
-user_cols_select_query_for_schema = user_cols_select_query + "WHERE U.schemaname = '%s'"
+	@staticmethod
+	def elapsed(t, times):
+		return numpy.maximum(t - times, 0.001)
+
+	@staticmethod
+	def nonzero(v):
+		return numpy.flatnonzero(v).tolist()
+
+	@staticmethod
+	def after(times, t):
+		return numpy.flatnonzero(times > t).tolist()
+
+	@staticmethod
+	def top(keys, n):
+		if [k for k in keys if not isinstance(k, numpy.ndarray)]:
+			return PgTopListOps.top(keys, n)
+		return numpy.lexsort(keys[::-1])[::-1][:n].tolist()
+
+	@staticmethod
+	def ratio(hit, read):
+		all = hit + read
+		return numpy.where(all > 0, 100.0 * hit / numpy.where(all > 0, all, 1), 100.0)
+
+	@staticmethod
+	def negative(v):
+		return -v
+
+	@staticmethod
+	def quotient(a, b):
+		return numpy.where(b > 0, a / numpy.where(b > 0, b, 1), 0.0)
+
+	@staticmethod
+	def select(v, sel):
+		if isinstance(v, numpy.ndarray):
+			return v[sel]
+		return [v[i] for i in sel]
+
+	@staticmethod
+	def tolist(v):
+		return v.tolist() if isinstance(v, numpy.ndarray) else v
+
+# The counters of the tables of one database, kept by column with a position
+# per table. Deltas, rates and the top rows are computed a column at a time,
+# by numpy when it is installed: per table there is only the lookup of its
+# position.
+class PgTopColumns:
+	def __init__(self, meta):
+		self.ops = PgTopNumpyOps if HAS_NUMPY else PgTopListOps
+		self.meta = meta
+		self.num = [n for n in xrange(0, len(meta)) if meta[n][USER_COL_TYPE] != "str"]
+		self.relids = []
+		self.pos = {}
+		self.times = self.ops.array([])
+		self.cols = dict([(n, self.ops.array([])) for n in self.num])
+		self.active = {} # positions of the rates not 0 at the last full update, by column
+
+	# (relids, counters, times) of the tables whose counter n changed over
+	# the last full scan interval or which were polled after since: an idle
+	# table is taken as still idle till the next full scan
+	def prev(self, n, since):
+		nz = sorted(set(self.active.get(n, [])).union(self.ops.after(self.times, since)))
+		times = self.ops.tolist(self.times)
+		counters = self.ops.tolist(self.cols[n])
+		return ([self.relids[i] for i in nz], [counters[i] for i in nz], [times[i] for i in nz])
+
+	# Takes the rows of a poll, (relid, columns...), at time t and returns the
+	# values of the columns; the tables not seen before count from 0 at base.
+	# A full poll replaces all the tables, otherwise only the ones polled are
+	# updated.
+	def update(self, data, t, base, full):
+		ops = self.ops
+		cols = zip(*data) if data else [()] * (len(self.meta) + 1)
+		relids = cols[0]
+		idx = [self.pos.get(r, -1) for r in relids]
+		at = ops.index(idx)
+		dt = ops.elapsed(t, ops.take(self.times, at, base))
+
+		new = {}
+		out = []
+		for n in xrange(0, len(self.meta)):
+			meta = self.meta[n]
+			if meta[USER_COL_TYPE] == "str":
+				out.append(cols[n + 1])
+				continue
+			new[n] = ops.array(cols[n + 1])
+			if meta[USER_COL_ABS]:
+				out.append(new[n])
+				continue
+			out.append(ops.rates(new[n], ops.take(self.cols[n], at, 0), \
+				dt if meta[USER_COL_METRIC].endswith("/s") else None))
+
+		if full:
+			# nothing changed yet on the first one
+			self.active = dict([(n, ops.nonzero(out[n])) for n in self.num
+				if self.relids and not self.meta[n][USER_COL_ABS]])
+			self.relids = list(relids)
+			self.pos = dict(itertools.izip(relids, itertools.count()))
+			self.times = ops.array([t] * len(relids))
+			self.cols = new
+		else:
+			known = [i for i in xrange(0, len(idx)) if idx[i] >= 0]
+			added = [i for i in xrange(0, len(idx)) if idx[i] < 0]
+			at = [idx[i] for i in known]
+			ops.put(self.times, at, [t] * len(at))
+			for n in self.num:
+				col = ops.tolist(new[n]) if added else new[n]
+				ops.put(self.cols[n], at, [col[i] for i in known] if added else col)
+				if added:
+					self.cols[n] = ops.append(self.cols[n], [col[i] for i in added])
+			if added:
+				self.times = ops.append(self.times, [t] * len(added))
+				for i in added:
+					self.pos[relids[i]] = len(self.relids)
+					self.relids.append(relids[i])
+		out.append(relids)
+		return out
+
+	# the row tuples of the top n tables by column sort, ties by the next ones;
+	# the columns in lowest are taken lowest first
+	def rows(self, out, n, sort, lowest=()):
+		if not out or not len(out[0]):
+			return []
+		keys = [self.ops.negative(out[c]) if c in lowest else out[c] for c in sort]
+		if len(out[0]) > n:
+			sel = self.ops.top(keys, n)
+			out = [self.ops.select(c, sel) for c in out]
+		return zip(*[self.ops.tolist(c) for c in out])
+
+# Keeps the frame on the terminal and writes only what a new one changes:
+# for every line the span between its first and last changed chars. The
+# whole screen is repainted only when the terminal is resized.
+class PgTopScreen:
+	def __init__(self, scr):
+		self.scr = scr
+		self.size = None
+		self.lines = []
+		self.attrs = {}
+
+	# attrs are the curses attributes of whole lines, by line
+	def draw(self, lines, attrs={}):
+		size = self.scr.getmaxyx()
+		if size != self.size:
+			self.size = size
+			self.lines = []
+			self.scr.clear()
+		(max_y, max_x) = size
+
+		# nothing goes to the last column, curses fails on the last cell
+		lines = [l[:max_x - 1] for l in lines[:max_y]]
+		for y in xrange(0, len(lines)):
+			new = lines[y]
+			old = self.lines[y] if y < len(self.lines) else ""
+			attr = attrs.get(y, curses.A_NORMAL)
+			if attr != self.attrs.get(y, curses.A_NORMAL):
+				self.scr.addstr(y, 0, new, attr)
+				self.scr.clrtoeol()
+				continue
+			if new == old:
+				continue
+			a = 0
+			n = min(len(new), len(old))
+			while a < n and new[a] == old[a]:
+				a += 1
+			if len(new) == len(old):
+				b = len(new)
+				while b > a and new[b - 1] == old[b - 1]:
+					b -= 1
+				self.scr.addstr(y, a, new[a:b], attr)
+			else:
+				self.scr.addstr(y, a, new[a:], attr)
+				if len(new) < len(old):
+					self.scr.clrtoeol()
+		for y in xrange(len(lines), len(self.lines)):
+			self.scr.move(y, 0)
+			self.scr.clrtoeol()
+		self.lines = lines
+		self.attrs = dict(attrs)
+
+		self.scr.noutrefresh()
+		curses.doupdate()
+
+# What one database has for a view: the counters as last seen and the rows
+# of the last poll
+class PgTopViewData:
+	def __init__(self):
+		self.polls = 0
+		self.full_time = None # time of the last full scan
+		self.columns = None # PgTopColumns
+		self.total_prev = None
+		self.rows = None # rows with the rates of the last poll
+		self.total = None
+		self.cache = {} # whatever the view keeps about its rows
+		self.epoch = None # what the view tells a reset of its counters by
+
+# One of the databases watched. Each is polled by its own job in a pool and
+# bounded by the connect and statement timeouts, so a slow or dead server
+# only makes its own rows stale.
+class PgTopConn:
+	def __init__(self, name, db, timeout):
+		self.name = name
+		self.db = db
+		self.timeout = timeout
+		self.con = None
+		self.error = None
+		self.busy = False
+		self.updated = None # time of the last successful poll
+		self.cpu = 0 # spent on the last poll
+		self.views = {} # PgTopViewData by view name
+		self.version = None # server_version_num
+
+	def data(self, view):
+		return self.views.setdefault(view.name, PgTopViewData())
+
+	def connect(self):
+		try:
+			self.con = self.db.connect(self.timeout)
+			cur = self.con.cursor()
+			try:
+				cur.execute("SET statement_timeout = %d" % int(self.timeout * 1000))
+				cur.execute("SELECT current_setting('server_version_num')::int")
+				self.version = cur.fetchone()[0]
+			finally:
+				cur.close()
+			self.con.commit()
+			self.error = None
+		except psycopg2.Error, e:
+			self.set_error(e)
+
+	def set_error(self, e):
+		self.error = str(e).strip().split("\n")[0] or type(e).__name__
+		logging.debug("%s: %s" % (self.name, str(e)))
+		if self.con is not None:
+			if self.con.closed:
+				self.con = None
+			else:
+				self.con.rollback()
+
+	# None if the rows of the database are up to date
+	def status(self, delay):
+		if self.error:
+			return "%s: %s" % (self.name, self.error)
+		if self.updated is None:
+			return "%s: connecting" % self.name
+		age = time.time() - self.updated
+		if age > 2 * delay:
+			return "%s: stale %ds" % (self.name, age)
+		return None
 
 
 class PgTop:
@@ -167,207 +1363,329 @@ class PgTop:
 		self.scr = None
 		self.opts = None
 		self.con = []
+		self.pool = None
 
 		self.paused = 0
 		self.terminate = False
 
 		self.mutex = threading.Lock()
-		self.prev_time = 0
-
-		if sys.stderr.isatty():
-			sys.stderr = StringIO.StringIO()
-
-		self.init_user_cols()
+		self.publish_mutex = threading.Lock()
+		self.sample_mutex = threading.Lock()
+		self.page = 50 # rows on the screen
+		self.draw_cpu = 0 # spent on the last redraw
+		self.screen = None
 
-	def init_user_cols(self):
-		self.user_cols_sorted = 0
-		self.user_cols_hash = {}
-		self.user_cols_data_prev = {}
-		self.user_cols_meta = []
-		self.user_cols_view_data = []
-		self.user_cols_view_ctime = time.ctime()
+		self.views = [v() for v in pg_top_views]
+		self.view = self.views[0]
 
-		for col in user_cols_def:
+		# the latest snapshot of the sampler and the one on the screen,
+		# they differ while paused
+		self.snapshot = None
+		self.shown = None
 
-			# hide dB if there is only one DB
-			if col[USER_COL_NAME].lower() == "db" and len(self.con) == 1:
-				continue
-
-			self.user_cols_meta.append(col)
-
-		for n in xrange(0, len(self.user_cols_meta)):
-			self.user_cols_hash[self.user_cols_meta[n][USER_COL_NAME]] = n
-			if self.opts and self.user_cols_meta[n][USER_COL_NAME] == self.opts.sort:
-				self.user_cols_sorted = n
+		if sys.stderr.isatty():
+			sys.stderr = StringIO.StringIO()
 
 	def init(self, scr, con, opts):
 		self.scr = scr
+		self.screen = PgTopScreen(scr) if scr else None
 		self.con = con
 		self.opts = opts
-		self.init_user_cols()
-
-	def fetch_user_cols(self):
-		cols = ", ".join([c[USER_COL_SQL_NAME] for c in self.user_cols_meta])
-		data = []
-		for name, con in self.con.items():
-			if self.opts.schema:
-				data += DB.execute_fetchall(con, user_cols_select_query_for_schema % (cols, self.opts.schema))
-			else:
-				data += DB.execute_fetchall(con, user_cols_select_query % cols)
-			con.commit()
-		return data
+		self.pool = ThreadPool(len(con))
+		for view in self.views:
+			view.init_cols(con, opts.sort if view.name == "tables" else None)
+			if view.name == opts.view:
+				self.view = view
+		if not scr:
+			# batch mode, nothing to hide the log from
+			self.deinit()
+			sys.stderr = sys.__stderr__
+			self.page = opts.top
+
+	# Every opts.full_scan polls all the rows are fetched, which refreshes
+	# their last seen counters; the polls between fetch from the server the
+	# rows on the screen only, as ordered by the sorted column. The first two
+	# are full, the rates of the first interval tell the tables changing.
+	def fetch(self, conn, view, data):
+		if view.was_reset(conn, data):
+			# the rows shown stay till the next poll has rates
+			data.polls = 0
+			data.full_time = None
+			data.columns = None
+			data.total_prev = None
+		full = data.polls < 2 or data.polls % self.opts.full_scan == 0
+		# the ratios of the interval are not known to the server
+		full = full or view.is_derived(view.meta[view.sorted]) or not view.counters
+		if full:
+			rows = DB.execute_fetchall(conn.con, view.query(conn.version, self.opts.schema))
+		else:
+			n = view.sorted
+			sort = view.meta[n]
+			prev = None
+			if sort[USER_COL_TYPE] != "str" and not sort[USER_COL_ABS]:
+				prev = data.columns.prev(n, data.full_time)
+			query = view.query(conn.version, self.opts.schema, sort, self.page + view.scroll,
+				prev, time.time(), data.full_time)
+			rows = DB.execute_fetchall(conn.con, query)
+		conn.con.commit()
+		data.polls += 1
+		return full, rows
+
+	# computes the rates of one database, there are none after its first poll
+	def update(self, conn, view, data, full, sql_data):
+		t = time.time()
+		cols = view.meta
+		ncols = len(cols)
 
-	def update_user_cols_view(self):
-		self.user_cols_view_ctime = time.ctime()
-		sql_data = self.fetch_user_cols()
+		if not view.counters:
+			data.rows, data.total = view.collect(conn, data, sql_data)
+			data.full_time = t
+			return
 
-		total = [0] * len(self.user_cols_meta)
-		total[0] = "Total"
+		if data.columns is None:
+			data.columns = PgTopColumns(cols)
+		out = data.columns.update(sql_data, t, data.full_time or t, full)
 
-		for data in sql_data:
-			for n in xrange(1, len(data)):
-				if self.user_cols_meta[n][USER_COL_TYPE] == "str":
-					total[n] = ""
+		# SUM() of bigint comes as Decimal
+		sums = [float(v or 0) for v in sql_data[0][ncols + 1:]] if sql_data else []
+		total = []
+		for c in cols:
+			if c[USER_COL_TYPE] == "str":
+				total.append("")
+			else:
+				total.append(sums.pop(0) if sums else 0)
+		if data.full_time is not None:
+			if "DB" in view.hash:
+				out[view.hash["DB"]] = [conn.name] * len(sql_data)
+			view.derive(out, data.columns.ops)
+			view.round(out, data.columns.ops)
+			data.rows = data.columns.rows(out, self.page + view.scroll, view.order(), view.lowest())
+			data.total = view.rates(total, data.total_prev, t, data.full_time)
+		data.total_prev = (t, total)
+		if full:
+			data.full_time = t
+
+	# polls one database for the view on the screen, runs in the pool; the
+	# first poll of a view is followed by another one soon, to get the rates
+	def poll(self, conn):
+		view = self.view
+		try:
+			if not conn.con:
+				conn.connect()
+			while conn.con:
+				data = conn.data(view)
+				if view.filter and view.filter[0] != conn.name:
+					data.rows = []
+					break
+				first = data.full_time is None and view.counters
+				full, rows = self.fetch(conn, view, data)
+				cpu = thread_cpu()
+				self.update(conn, view, data, full, rows)
+				conn.cpu = thread_cpu() - cpu
+				if data.rows:
+					data.rows = view.finish(conn, data, data.rows)
+				conn.error = None
+				conn.updated = time.time()
+				if not first or view is not self.view:
+					break
+				time.sleep(0.3)
+		except psycopg2.Error, e:
+			conn.set_error(e)
+		except Exception, e:
+			logging.error(traceback.format_exc())
+			conn.error = str(e)
+		conn.busy = False
+		self.publish()
+
+	# merges the last rows of all the databases into a new snapshot, called
+	# whenever a poll is done
+	def publish(self):
+		self.publish_mutex.acquire()
+		try:
+			view = self.view
+			rows = []
+			total = None
+			for conn in self.con:
+				data = conn.views.get(view.name)
+				if data is None:
+					continue
+				rows += data.rows or []
+				if data.total is None:
+					continue
+				if total is None:
+					total = list(data.total)
 				else:
-					total[n] += data[n] if data[n] else 0
-		sql_data = [total] + sql_data
+					view.add_total(total, data.total)
+			if total is not None:
+				total[0] = "Total"
+				out = [[v] for v in total]
+				view.derive(out, PgTopListOps)
+				view.round(out, PgTopListOps)
+				total = tuple([v[0] for v in out]) + (None,)
+			status = [c.status(self.opts.delay) for c in self.con]
+			self.snapshot = PgTopSnapshot(view, time.ctime(), rows, [s for s in status if s], total,
+				sum([c.cpu for c in self.con]))
+			if not self.paused:
+				self.shown = self.snapshot
+		finally:
+			self.publish_mutex.release()
+		if not self.paused:
+			self.refresh()
 
-		user_data = {}
-		for r in sql_data:
-			user_data[r[0]] = r
+	# waits for the polls started until the deadline at most
+	def wait(self, deadline):
+		while [c for c in self.con if c.busy] and time.time() < deadline:
+			time.sleep(0.01)
 
-		if not self.prev_time:
-			self.user_cols_data_prev = user_data
-			self.prev_time = time.time()
+	# starts a poll of every database not busy with the previous one
+	def sample(self):
+		late = False
+		self.sample_mutex.acquire()
+		try:
+			for conn in self.con:
+				if conn.busy:
+					late = True
+					continue
+				conn.busy = True
+				self.pool.apply_async(self.poll, (conn,))
+		finally:
+			self.sample_mutex.release()
+		if late:
+			# nothing may come from the late ones, show them stale
+			self.publish()
+
+	# the Total row and the rows of the snapshot shown, sorted
+	def get_view_data(self):
+		shown = self.shown
+		if shown is None or shown.total is None or shown.view is not self.view:
 			return None
-
-		self.user_cols_view_data = []
-
-		t = time.time()
-		for data in sql_data:
-			out = []
-
-			table = data[0]
-
-			for n in xrange(0, len(data)):
-				if self.user_cols_meta[n][USER_COL_TYPE] == "str":
-					s = str(data[n])
-					w = self.user_cols_meta[n][USER_COL_WIDTH]
-					if len(s) > w:
-						s = s[0:w-3] + "..."
-					out.append(s)
-				elif self.user_cols_meta[n][USER_COL_ABS]:
-					out.append(data[n])
-				else:
-					new = data[n] if data[n] else 0
-					old = self.user_cols_data_prev[table][n] if self.user_cols_data_prev.has_key(table) and \
-						self.user_cols_data_prev[table][n] else 0
-					out.append(new - old)
-
-			for n in xrange(0, len(out)):
-				if self.user_cols_meta[n][USER_COL_METRIC].endswith("/s"):
-					if t - self.prev_time:
-						out[n] = int(out[n]) / (t - self.prev_time)
-				if self.user_cols_meta[n][USER_COL_TYPE] == "int":
-					out[n] = round(out[n])
-
-			self.user_cols_view_data.append(out)
-
-		self.user_cols_data_prev = user_data
-		self.prev_time = t
-
-	def get_user_cols_view_data(self):
-		return sorted(self.user_cols_view_data, key=lambda x:
-			(x[self.user_cols_sorted],
-			x[self.user_cols_hash['Write']],
-			x[self.user_cols_hash['Reltuples']]),
-			reverse=True)
+		return [shown.total] + self.view.sort_rows(shown.rows)
+
+	# Switches the screen to another view. The tables selected in the tables
+	# view becomes the filter of a view of its parts.
+	def set_view(self, view):
+		if view.parent:
+			view.filter = None
+			rows = self.get_view_data() if self.view.name == "tables" else None
+			if rows and 0 < self.view.cursor < len(rows):
+				row = rows[self.view.cursor]
+				db = row[self.view.hash["DB"]] if "DB" in self.view.hash else self.con[0].name
+				view.filter = (db, row[-1], row[0] if len(self.con) == 1 else "%s/%s" % (db, row[0]))
+		view.cursor = view.scroll = 0
+		self.view = view
+		self.paused = 0
+		for conn in self.con:
+			conn.views.pop(view.name, None)
+		self.sample()
 
 	def _refresh(self):
 		if not self.scr or self.terminate:
 			return
+		view = self.view
 		(max_y, max_x) = self.scr.getmaxyx()
-
-		s = sum([c[1] + 1 for c in self.user_cols_meta])
-		s -= self.user_cols_meta[0][USER_COL_WIDTH]
-		self.user_cols_meta[0][USER_COL_WIDTH] = max_x - s
-
-		fmt = []
-		for c in self.user_cols_meta:
-			if c[USER_COL_TYPE] == "int":
-				fmt.append("%%%dd" % c[1])
-			elif c[USER_COL_TYPE] == "float":
-				fmt.append("%%%d.1f" % c[1])
-			else:
-				fmt.append("%%%ds" % c[1])
-		fmt_data = " ".join(fmt)
-		fmt_header = " ".join(["%%%ds" % c[USER_COL_WIDTH] for c in self.user_cols_meta])
-
-		self.scr.erase()
-		self.scr.addstr(0, 0, "%s | Use: 'left' and 'right' keys - select sortable col; 'p' pause; 'q' quit; 'space' refresh"
-			% self.user_cols_view_ctime)
+		self.page = max(1, max_y - 6)
+		fmt_data, fmt_header = view.get_formats(max_x)
+
+		lines = []
+		attrs = {}
+		cpu = (self.shown.cpu if self.shown else 0) + self.draw_cpu
+		line = "%s | cpu %.1fms %s | Use: 'left' and 'right' keys - select sortable col; 'up' and 'down' - select row; " \
+			"'p' pause; 'q' quit; 'space' refresh; %s" % (self.shown.ctime if self.shown else time.ctime(),
+			cpu * 1000, PgTopNumpyOps.name if HAS_NUMPY else PgTopListOps.name,
+			"; ".join(["'%s' %s" % (v.key, v.name) for v in self.views]))
 		if self.paused:
-			self.scr.addstr(0, 0, "PAUSED! ")
-		self.scr.addstr(1, 0, "=" * max_x)
+			line = "PAUSED! " + line[8:]
+		lines.append(line)
+		status = list(self.shown.status if self.shown else ())
+		if view is not self.views[0]:
+			status.insert(0, view.describe())
+		if len(self.con) > 1 or status:
+			line = "= %s " % (" | ".join(status) if status else "%d databases" % len(self.con))
+			lines.append((line + "=" * max_x)[:max_x])
+		else:
+			lines.append("=" * max_x)
 		columns = []
 		metrics = []
 
-		for n in xrange(0, len(self.user_cols_meta)):
-			c = self.user_cols_meta[n]
+		for n in xrange(0, len(view.meta)):
+			c = view.meta[n]
 			metrics.append(c[USER_COL_METRIC])
-			if self.user_cols_sorted == n:
+			if view.sorted == n:
 				columns.append("*" + c[USER_COL_NAME])
 			else:
 				columns.append(c[USER_COL_NAME])
 
-		self.scr.addstr(2, 0, fmt_header % tuple(columns))
-		self.scr.addstr(3, 0, fmt_header % tuple(metrics))
-
-		if not self.paused:
-			self.update_user_cols_view()
-		view = self.get_user_cols_view_data()
-
-		if view == None:
-			return
-
-		self.scr.addstr(4, 0, "-" * max_x)
-		r = 4
-		for row in view:
-			r += 1
-			if r == max_y:
-				break
-			self.scr.addstr(r, 0, fmt_data % tuple(row))
-
-		self.scr.refresh()
+		lines.append(fmt_header % tuple(columns))
+		lines.append(fmt_header % tuple(metrics))
+
+		rows = self.get_view_data()
+
+		if rows != None:
+			lines.append("-" * max_x)
+			# the total row stays on top when scrolling, the selected one
+			# stays on the screen
+			room = max_y - 6
+			view.cursor = max(0, min(view.cursor, len(rows) - 1))
+			if view.cursor:
+				view.scroll = min(view.scroll, view.cursor - 1)
+				view.scroll = max(view.scroll, view.cursor - room)
+			view.scroll = max(0, min(view.scroll, len(rows) - 1 - room))
+			attrs[5 + (view.cursor - view.scroll if view.cursor else 0)] = curses.A_REVERSE
+			rows = rows[:1] + rows[1 + view.scroll:]
+			for row in rows[:max_y - len(lines)]:
+				attr = view.attr(row)
+				if attr:
+					attrs[len(lines)] = attrs.get(len(lines), curses.A_NORMAL) | attr
+				lines.append(view.format_row(row, fmt_data))
+
+		self.screen.draw(lines, attrs)
 
 	def refresh(self):
 		self.mutex.acquire()
 		try:
+			cpu = thread_cpu()
 			self._refresh()
+			self.draw_cpu = thread_cpu() - cpu
 		except:
 			self.mutex.release()
 			raise
 		self.mutex.release()
 
 	def shift_sorted_col(self, shift):
-		self.user_cols_sorted = (len(self.user_cols_meta) + self.user_cols_sorted + shift) % len(self.user_cols_meta)
+		view = self.view
+		view.sorted = (len(view.meta) + view.sorted + shift) % len(view.meta)
 
 	def handle_key(self, key):
-		if ord(key) == KEY_LEFT:
-			self.shift_sorted_col(-1)
-		elif ord(key) == KEY_RIGHT:
-			self.shift_sorted_col(1)
+		views = dict([(v.key, v) for v in self.views])
+		if ord(key) in (KEY_LEFT, KEY_RIGHT):
+			# the rows at hand are the top of the previous column, the
+			# next tick fetches the top of this one
+			self.shift_sorted_col(-1 if ord(key) == KEY_LEFT else 1)
+		elif ord(key) == KEY_UP:
+			self.view.cursor = max(0, self.view.cursor - 1)
+		elif ord(key) == KEY_DOWN:
+			self.view.cursor += 1
 		elif key == 'p':
 			self.paused = self.paused ^ 1
+			if not self.paused:
+				self.shown = self.snapshot
 		elif key == ' ':
 			if self.paused:
 				self.paused = 0
+			self.shown = self.snapshot
+		elif key in views:
+			self.set_view(views[key])
 		else:
 			return
+		# only the snapshot at hand is re-sorted and redrawn, the database
+		# is left to the sampler
 		self.refresh()
 
 	def getkey(self):
 		try:
+			# wake up now and then to see if the sampler is done with --count
+			if not select.select([sys.stdin], [], [], 0.5)[0]:
+				return chr(0)
 			# return chr(self.scr.getch()) - thread unsafe
 			key = sys.stdin.read(1)
 		except KeyboardInterrupt:
@@ -395,16 +1713,22 @@ class PgTop:
 		self.deinit()
 
 
+# The sampler thread: starts the polls of the databases every opts.delay,
+# the keys are handled meanwhile by the main thread
 def main_loop(pgt):
 	try:
 		pgt.refresh()
-		time.sleep(0.3)
+		n = 0
 		while 1:
-			if not pgt.paused:
-				pgt.refresh()
-			time.sleep(pgt.opts.delay)
+			t = time.time()
+			pgt.sample()
 			if pgt.terminate:
 				return
+			time.sleep(max(0, pgt.opts.delay - (time.time() - t)))
+			n += 1
+			if pgt.opts.count and n >= pgt.opts.count:
+				pgt.terminate = True
+				return
 	except:
 		pgt.handle_exc()
 		os._exit(1)
@@ -420,7 +1744,7 @@ def pg_top(scr, pgt, con, opts):
 	t.daemon = True
 	t.start()
 
-	while 1:
+	while not pgt.terminate:
 		try:
 			key = pgt.getkey()
 			if key == 'q':
@@ -430,13 +1754,102 @@ def pg_top(scr, pgt, con, opts):
 			break
 	pgt.terminate = True
 
+# Batch output: the Total row and the top rows of every snapshot, with its
+# time, like 'top -b'. Only the snapshot at hand is kept, so the memory
+# stays the same however long it runs.
+class PgTopTextOutput:
+	# the width of the Table column, there is no terminal to fill
+	TABLE_WIDTH = 32
+
+	def __init__(self, pgt):
+		self.pgt = pgt
+		self.f = sys.stdout
+		width = sum([c[USER_COL_WIDTH] + 1 for c in pgt.view.meta[1:]]) + self.TABLE_WIDTH
+		self.fmt_data, self.fmt_header = pgt.view.get_formats(width)
+
+	def write(self, ts, rows, status):
+		meta = self.pgt.view.meta
+		self.f.write(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)) + "\n")
+		for s in status:
+			self.f.write("= %s\n" % s)
+		self.f.write(self.fmt_header % tuple([c[USER_COL_NAME] for c in meta]) + "\n")
+		self.f.write(self.fmt_header % tuple([c[USER_COL_METRIC] for c in meta]) + "\n")
+		for row in rows:
+			self.f.write(self.pgt.view.format_row(row, self.fmt_data) + "\n")
+		self.f.write("\n")
+		self.f.flush()
+
+class PgTopRecordOutput:
+	def __init__(self, pgt):
+		self.pgt = pgt
+		self.f = sys.stdout
+		self.fields = [c[USER_COL_SQL_NAME] for c in pgt.view.meta]
+
+	def values(self, row):
+		out = []
+		for n in xrange(0, len(self.fields)):
+			if self.pgt.view.meta[n][USER_COL_TYPE] == "int":
+				out.append(int(row[n]))
+			else:
+				out.append(row[n])
+		return out
+
+class PgTopCsvOutput(PgTopRecordOutput):
+	def __init__(self, pgt):
+		PgTopRecordOutput.__init__(self, pgt)
+		self.w = csv.writer(self.f, lineterminator="\n")
+		self.w.writerow(["ts", "rank"] + self.fields)
+		self.f.flush()
+
+	def write(self, ts, rows, status):
+		for n in xrange(0, len(rows)):
+			self.w.writerow([repr(ts), n] + [repr(v) if isinstance(v, float) else v for v in self.values(rows[n])])
+		self.f.flush()
+
+class PgTopJsonOutput(PgTopRecordOutput):
+	def write(self, ts, rows, status):
+		rec = OrderedDict()
+		rec["ts"] = ts
+		if status:
+			rec["status"] = list(status)
+		rec["total"] = OrderedDict(zip(self.fields, self.values(rows[0]))[1:])
+		rec["rows"] = [OrderedDict(zip(self.fields, self.values(r))) for r in rows[1:]]
+		self.f.write(json.dumps(rec) + "\n")
+		self.f.flush()
+
+def make_output(pgt, opts):
+	if opts.format == "csv":
+		return PgTopCsvOutput(pgt)
+	if opts.format == "jsonl":
+		return PgTopJsonOutput(pgt)
+	return PgTopTextOutput(pgt)
+
+# Batch mode: the same polls without curses, a snapshot printed every delay
+def pg_batch(pgt, con, opts):
+	pgt.init(None, con, opts)
+	out = make_output(pgt, opts)
+	n = 0
+	while 1:
+		t = time.time()
+		pgt.sample()
+		pgt.wait(t + opts.delay)
+		view = pgt.get_view_data()
+		if view:
+			out.write(t, view[:opts.top + 1], pgt.shown.status)
+			n += 1
+			if opts.count and n >= opts.count:
+				return
+		time.sleep(max(0, opts.delay - (time.time() - t)))
+
 def main():
 	test_description = "%prog [options]"
 	pgt = PgTop()
 
 	epilog = "\nCounters description:"
-	for c in pgt.user_cols_meta:
-		epilog += "\n%9s - %s" % (c[USER_COL_NAME], c[USER_COL_HELP])
+	for v in pgt.views:
+		epilog += "\n\n%s view, key '%s':" % (v.name, v.key)
+		for c in v.cols_def:
+			epilog += "\n%9s - %s" % (c[USER_COL_NAME], c[USER_COL_HELP])
 
 	class PgOptParser(OptionParser):
 		def format_epilog(self, formatter):
@@ -451,6 +1864,20 @@ def main():
 		choices=tuple([c[USER_COL_NAME] for c in user_cols_def]), help="sort by given column (default is '%default')")
 	p.add_option("-S", "--schema",  type="string",
 		help="take into account only given schema (default: all schemas)")
+	p.add_option("-D", "--dsn",     type="string", action="append", default=[],
+		help="libpq connection string or postgresql:// URL of a database to watch, may be repeated for shards")
+	p.add_option("-t", "--timeout", type=float, default=10,
+		help="connect and statement timeout of each database (sec) [default: %default]")
+	p.add_option("-V", "--view",    type="choice", default="tables", choices=tuple([v.name for v in pgt.views]),
+		help="view to start with: %s [default: %%default]" % ", ".join([v.name for v in pgt.views]))
+	p.add_option("-b", "--batch",   action="store_true",
+		help="print the top tables every delay instead of the screen, e.g. for cron jobs")
+	p.add_option("-N", "--top",     type=int, default=20, help="tables printed in batch mode [default: %default]")
+	p.add_option("-f", "--format",  type="choice", default="text", choices=("text", "csv", "jsonl"),
+		help="batch output format: text, csv or jsonl (one JSON object per snapshot) [default: %default]")
+	p.add_option("", "--full-scan", type=int, default=30,
+		help="fetch all the tables every N polls, only the rows on the screen between them; "
+		"1 fetches all each time [default: %default]")
 
 	defdb = ""
 	defusr = "postgres"
@@ -475,15 +1902,22 @@ def main():
 	loglevel = logging.DEBUG if opts.verbose else logging.WARNING
 	logging.basicConfig(level=loglevel, format="%(asctime)s - %(module)s - %(levelname)s - %(message)s")
 
-	dbs = []
-	con = {}
+	dbs = [DSN(dsn) for dsn in opts.dsn]
 
 	if HAS_PA:
-		if not opts.config and not opts.db_host:
-			p.error("either -c or --db-host option must be provided")
+		if not opts.config and not opts.db_host and not dbs:
+			p.error("either -c, --db-host or --dsn option must be provided")
 	else:
-		if not opts.db_host:
-			p.error("--db-host option must be provided")
+		if not opts.db_host and not dbs:
+			p.error("--db-host or --dsn option must be provided")
+	if opts.timeout <= 0:
+		p.error("--timeout must be positive")
+	if opts.full_scan < 1:
+		p.error("--full-scan must be at least 1")
+	if opts.top < 1:
+		p.error("--top must be at least 1")
+	if opts.format != "text" and not opts.batch:
+		p.error("--format is for --batch mode")
 
 	if HAS_PA and opts.config:
 		non = not opts.pba and not opts.poa
@@ -493,17 +1927,38 @@ def main():
 			dbs.append(DB(cfg.pba_db.ip, cfg.pba_db.db_port, cfg.pba_db.db_name, cfg.pba_db.db_user, cfg.pba_db.db_pass))
 		if (non or opts.poa) and cfg.poa_db.host:
 			dbs.append(DB(cfg.poa_db.ip, cfg.poa_db.db_port, cfg.poa_db.db_name, cfg.poa_db.db_user, cfg.poa_db.db_pass))
-	else:
+	elif opts.db_host:
 		dbs.append(DB(opts.db_host, opts.db_port, opts.db_name, opts.db_user, opts.db_pass))
 
+	# shards usually share the database name, tell them apart by host then
+	names = [db.get_name() for db in dbs]
+	con = []
 	for db in dbs:
-		print "Connecting to %s..." % str(db)
+		name = db.get_name()
+		if names.count(name) > 1:
+			name = "%s/%s" % (db.get_host(), name)
+		con.append(PgTopConn(name, db, opts.timeout))
+
+	# in batch mode stdout is for the data
+	out = sys.stderr if opts.batch else sys.stdout
+	for c in con:
+		print >> out, "Connecting to %s..." % str(c.db)
+	pool = ThreadPool(len(con))
+	pool.map(PgTopConn.connect, con)
+	pool.close()
+	for c in con:
+		if c.error:
+			print >> out, "%s: failed to connect: %s" % (c.name, c.error)
+
+	# the failed ones are retried in the background
+	if not [c for c in con if c.con]:
+		sys.exit(1)
+	if opts.batch:
 		try:
-			con[db.get_name()] = db.connect()
-		except Exception, x:
-			print "failed to connect: ", type(x), str(x)
-
-	if con:
+			pg_batch(pgt, con, opts)
+		except KeyboardInterrupt:
+			pass
+	else:
 		try:
 			curses.wrapper(pg_top, pgt, con, opts)
 		except: